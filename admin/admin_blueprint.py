@@ -1,10 +1,10 @@
+import os
 from collections import defaultdict
 from datetime import date
 from uuid import UUID, uuid4
 
 from flask import Blueprint, jsonify, redirect, render_template, request, url_for
 from flask_httpauth import HTTPBasicAuth
-from poprox_storage.aws import DB_ENGINE
 from poprox_storage.concepts.experiment import Team
 from poprox_storage.repositories import (
     DbAccountRepository,
@@ -19,7 +19,24 @@ from werkzeug.security import check_password_hash, generate_password_hash
 
 from poprox_concepts.api.click_filtering import filter_click_histories
 from poprox_concepts.domain.click import Click
+from util.cache import cache_stats
 from util.config import require_secret
+from util.email_outbox import email_outbox
+from util.entity_index import entity_index
+from util.newsletter_requests import newsletter_requests
+from util.postgres_db import (
+    DB_ENGINE,
+    REPLICA_ROUTER,
+    db_connection,
+    exclude_scanner_clicks,
+    get_accounts,
+    notify_account_changed,
+    pool_stats,
+    read_only,
+    rollback_request_connection,
+)
+from util.scanner_detection import scanner_detector
+from util.write_buffer import buffer_stats
 
 admin = Blueprint("admin", __name__, template_folder="templates", url_prefix="/admin")
 admin_auth = HTTPBasicAuth()
@@ -40,7 +57,7 @@ def verify_password(username, password):
 def show():
     error = request.args.get("error")
 
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         experiment_repo = DbExperimentRepository(conn)
         today = date.today()
 
@@ -57,13 +74,14 @@ def show():
 ### DATA API ###
 @admin.get("/api/clicks/by_day")
 @admin_auth.login_required
+@read_only
 def get_clicks_by_day():
     # flag parameter, include as `...&include_all&...` or `...&include_all=True&...`
     include_all = request.args.get("include_all") is not None
     days_ago = int(request.args.get("days_ago", 31))
 
     # quite frankly, this doesn't look very efficient.
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         dbClicksRepository: DbClicksRepository = DbClicksRepository(conn)
         dbNewsletterRepository: DbNewsletterRepository = DbNewsletterRepository(conn)
         dbAccountRepository: DbAccountRepository = DbAccountRepository(conn)
@@ -81,7 +99,7 @@ def get_clicks_by_day():
         clicks_by_account = dbClicksRepository.fetch_clicks_by_newsletter_ids(
             [newsletter.newsletter_id for newsletter in newsletters]
         )
-        clicks_by_account = filter_click_histories(clicks_by_account)
+        clicks_by_account = filter_click_histories(exclude_scanner_clicks(conn, clicks_by_account))
         print("fetched clicks")
         # aggregate to counts-per-day.
         clicks_by_newsletter: dict[UUID, list[Click]] = defaultdict(list)
@@ -95,6 +113,41 @@ def get_clicks_by_day():
         return jsonify({k.isoformat(): v for k, v in clicks_by_day.items()})
 
 
+@admin.get("/api/ingest_stats")
+@admin_auth.login_required
+def get_ingest_stats():
+    # counters for this worker process only
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "buffers": buffer_stats(),
+            "scanner_detection": scanner_detector.stats(),
+            "email_outbox": email_outbox.stats(),
+            "newsletter_requests": newsletter_requests.stats(),
+        }
+    )
+
+
+@admin.get("/api/db_pool")
+@admin_auth.login_required
+def get_db_pool_stats():
+    # the pool belongs to this worker process
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "primary": pool_stats(DB_ENGINE),
+            "replica": REPLICA_ROUTER.stats() if REPLICA_ROUTER is not None else None,
+        }
+    )
+
+
+@admin.get("/api/cache_stats")
+@admin_auth.login_required
+def get_cache_stats():
+    # counters for this worker process only
+    return jsonify({"pid": os.getpid(), "caches": cache_stats(), "entity_index": entity_index.stats()})
+
+
 ### TEAM MANAGEMENT ###
 
 
@@ -102,7 +155,7 @@ def get_clicks_by_day():
 @admin_auth.login_required
 def team_manage():
     error = request.args.get("error")
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
         teams = team_repo.fetch_teams()
         return render_template("admin_team_management.html", error=error, teams=teams)
@@ -113,19 +166,18 @@ def team_manage():
 def team_details(team_id):
     error = request.args.get("error")
 
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
-        account_repo = DbAccountRepository(conn)
         team = team_repo.fetch_team_by_id(team_id)
-        members = account_repo.fetch_accounts(team.members)
-        return render_template("admin_edit_team.html", team=team, error=error, members=members)
+    members = get_accounts(team.members, include_teams=False)
+    return render_template("admin_edit_team.html", team=team, error=error, members=members)
 
 
 @admin.post("/team/<team_id>")
 @admin_auth.login_required
 def edit_team_name(team_id):
     new_name = request.form.get("team_name")
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
         account_repo = DbAccountRepository(conn)
 
@@ -134,7 +186,8 @@ def edit_team_name(team_id):
         team_repo.store_team(team)
         members = account_repo.fetch_accounts(team.members)
 
-        conn.commit()
+        for member in team.members:
+            notify_account_changed(member)
         return render_template("admin_edit_team.html", team=team, members=members)
 
 
@@ -142,7 +195,7 @@ def edit_team_name(team_id):
 @admin_auth.login_required
 def add_to_team(team_id):
     email = request.form.get("email", "")
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
         account_repo = DbAccountRepository(conn)
         account = account_repo.fetch_account_by_email(email)
@@ -152,9 +205,10 @@ def add_to_team(team_id):
             )
         try:
             team_repo.insert_team_membership(team_id, account.account_id)
-            conn.commit()
+            notify_account_changed(account.account_id)
             return redirect(url_for("admin.team_details", team_id=team_id))
         except ValueError as e:
+            rollback_request_connection()
             return redirect(url_for("admin.team_details", team_id=team_id, error=str(e)))
 
 
@@ -162,11 +216,10 @@ def add_to_team(team_id):
 @admin_auth.login_required
 def new_team():
     team_name = request.form.get("team_name", "untitled team")
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
         team = Team(team_id=uuid4(), team_name=team_name, members=[])
         team_repo.store_team(team)
-        conn.commit()
         return redirect(url_for("admin.team_details", team_id=team.team_id))
 
 
@@ -177,7 +230,7 @@ def new_team():
 @admin_auth.login_required
 def account_search():
     accounts = []
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         if request.args.get("account_id"):
             accounts = account_repo.fetch_accounts(request.args["account_id"])
@@ -190,7 +243,7 @@ def account_search():
 @admin.get("/account/<account_id>")
 @admin_auth.login_required
 def account_detail(account_id):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account = account_repo.fetch_accounts([account_id])
         if len(account) == 0:
@@ -204,7 +257,7 @@ def account_detail(account_id):
 @admin.post("/account/<account_id>")
 @admin_auth.login_required
 def update_account_detail(account_id):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account = account_repo.fetch_accounts([account_id])
         if len(account) == 0:
@@ -221,9 +274,9 @@ def update_account_detail(account_id):
 
         try:
             account_repo.store_account(account, commit=False)
-            conn.commit()
+            notify_account_changed(account_id)
         except (IntegrityError, InternalError) as err:
-            conn.rollback()
+            rollback_request_connection()
             return redirect(
                 url_for("admin.account_detail", account_id=account_id, error="update not applied: " + str(err))
             )
@@ -236,17 +289,17 @@ def update_account_detail(account_id):
 def force_unsubscribe(account_id):
     if request.form.get("confirm"):
         try:
-            with DB_ENGINE.connect() as conn:
+            with db_connection() as conn:
                 subscription_repo = DbSubscriptionRepository(conn)
                 account_repo = DbAccountRepository(conn)
 
                 subscription_repo.remove_subscription_for_account(account_id)
                 account_repo.update_status(account_id, "admin unsubscribe")
-                conn.commit()
+                notify_account_changed(account_id)
 
                 return redirect(url_for("admin.account_detail", account_id=account_id, error="unsubbed"))
         except (IntegrityError, InternalError) as err:
-            conn.rollback()
+            rollback_request_connection()
             return redirect(
                 url_for("admin.account_detail", account_id=account_id, error="update not applied: " + str(err))
             )
@@ -3,24 +3,21 @@
 import logging
 from datetime import datetime, timezone
 from os import environ as env
+from pathlib import Path
 
 from dotenv import find_dotenv, load_dotenv
-from flask import Flask, jsonify, redirect, render_template, request, send_file, url_for
+from flask import Flask, Response, jsonify, redirect, render_template, request, url_for
 from flask_wtf.csrf import CSRFProtect
 
 ENV_FILE = find_dotenv()
 if ENV_FILE:
     load_dotenv(ENV_FILE)
 
-from poprox_storage.aws.queues import enqueue_newsletter_request
 from poprox_storage.repositories.account_interest_log import DbAccountInterestRepository
 from poprox_storage.repositories.accounts import DbAccountRepository
-from poprox_storage.repositories.articles import DbArticleRepository
-from poprox_storage.repositories.clicks import DbClicksRepository
 from poprox_storage.repositories.compensation import DbCompensationRepository
 from poprox_storage.repositories.demographics import DbDemographicsRepository
 from poprox_storage.repositories.experiments import DbExperimentRepository
-from poprox_storage.repositories.images import DbImageRepository
 from poprox_storage.repositories.newsletters import DbNewsletterRepository
 from poprox_storage.repositories.subscriptions import DbSubscriptionRepository
 
@@ -29,7 +26,7 @@ from dev.dev_blueprint import dev
 from experimenter.experimenter_blueprint import exp
 from poprox_concepts.api.recommendations.versions import ProtocolVersions
 from poprox_concepts.api.tracking import LoginLinkData, SignUpLinkData, TrackingLinkData
-from poprox_concepts.domain import Account, AccountInterest
+from poprox_concepts.domain import AccountInterest
 from poprox_concepts.domain.account import COMPENSATION_CARD_OPTIONS, COMPENSATION_CHARITY_OPTIONS
 from poprox_concepts.domain.demographics import (
     EDUCATION_OPTIONS,
@@ -41,35 +38,57 @@ from poprox_concepts.domain.demographics import (
 from poprox_concepts.domain.topics import GENERAL_TOPICS
 from poprox_concepts.internals import from_hashed_base64
 from static_web.blueprint import static_web
+from util.activity_counters import get_activity_counts
 from util.auth import auth
+from util.click_tracking import record_click, replay_spooled_clicks
 from util.config import require_secret
+from util.entity_affinity import bump_account_versions, ensure_seeded, fetch_account_version, top_entities
+from util.entity_index import ENTITY_PAGE_TYPES, entity_index, starter_entities
+from util.entity_search import fold
+from util.etags import make_etag, not_modified, with_etag
+from util.newsletter_requests import newsletter_requests
+from util.newsletters import cached_newsletter_with_images, fetch_impression_feedback
+from util.open_tracking import OpenTrackingData, record_open
 from util.postgres_db import (
     DB_ENGINE,
+    close_request_connection,
+    commit_request_connection,
+    db_connection,
     fetch_compensation_preferences,
     fetch_demographic_information,
-    fetch_user_click_and_survey_activity,
     finish_consent,
     finish_demographic_survey,
     finish_onboarding,
     finish_topic_selection,
     get_token,
+    mark_read_only,
+    notify_account_changed,
+    read_only,
 )
+from util.sessions import make_session_interface
+from util.sql_instrumentation import report_request_queries
+from util.tables import create_web_tables
+from util.topic_index import topic_index
 
 logger = logging.getLogger(__name__)
 
 COMPENSATION_OPTIONS = COMPENSATION_CARD_OPTIONS + COMPENSATION_CHARITY_OPTIONS + ["Decline payment"]
 
-# Entity types handled by the People, Organizations & Places page (topics/subjects
-# are managed on the separate Customize Newsletter page and are excluded here).
-ENTITY_PAGE_TYPES = {"person", "organization", "place"}
-
 DEFAULT_RECS_ENDPOINT_URL = env.get("POPROX_DEFAULT_RECS_ENDPOINT_URL")
 DEFAULT_SOURCE = "website"
 URL_PREFIX = env.get("URL_PREFIX", "/")
 
 app = Flask(__name__)
 app.secret_key = require_secret("APP_SECRET_KEY", "defaultpoproxsecretkey")
+# "postgres" or "memory" keep the session on the server and only an opaque id in the cookie
+SESSION_INTERFACE = make_session_interface(env.get("SESSION_BACKEND", "cookie"), DB_ENGINE)
+if SESSION_INTERFACE is not None:
+    app.session_interface = SESSION_INTERFACE
 csrf = CSRFProtect(app)
+# one connection and transaction per request, shared by every view and helper
+app.after_request(commit_request_connection)
+app.teardown_request(close_request_connection)
+app.after_request(report_request_queries)
 HMAC_KEY = require_secret("POPROX_HMAC_KEY", "defaultpoproxhmackey")
 
 TOPIC_HINTS = {
@@ -165,10 +184,9 @@ def email_redirect(path):
     data: LoginLinkData = from_hashed_base64(path, HMAC_KEY, LoginLinkData)
     auth.login_via_account_id(data.account_id)
 
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account_repo.store_login(data)
-        conn.commit()
 
     # redirect for deprecated endpoint.
     if data.endpoint == "email_unsubscribe":
@@ -256,15 +274,13 @@ def logout():
 @auth.requires_login
 def opt_out_of_experiments():
     account_id = auth.get_account_id()
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         experiment_repo = DbExperimentRepository(conn)
         experiment_repo.update_expt_assignment_to_opt_out(account_id)
 
         account_repo = DbAccountRepository(conn)
         account_repo.set_placebo_id(account_id)
 
-        conn.commit()
-
     return redirect(
         url_for(
             "home",
@@ -285,10 +301,9 @@ def unsubscribe():
 def pre_unsubscribe():
     main_menu = request.form.get("main-menu")
     sub_menu = request.form.get("sub-menu")
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         subscription_repo = DbSubscriptionRepository(conn)
-        # TODO: Explicitly wrap with transactions?
         if main_menu == "unsubscribe-from-poprox" and sub_menu == "unsubscribe-without-any-removal":
             account_repo.end_consent_for_account(auth.get_account_id())
             subscription_repo.remove_subscription_for_account(auth.get_account_id())
@@ -311,7 +326,7 @@ def pre_unsubscribe():
             return redirect(url_for("opt_out_of_experiments"))
         else:
             return render_template("pre_unsubscribe.html", error="Please choose an option below")
-        conn.commit()
+    notify_account_changed(auth.get_account_id())
     return render_template(("post_unsubscribe.html"), error=error_description)
 
 
@@ -319,10 +334,9 @@ def pre_unsubscribe():
 @auth.requires_login
 def subscribe():
     account_id = auth.get_account_id()
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         subscription_repo = DbSubscriptionRepository(conn)
         subscription_repo.store_subscription_for_account(account_id)
-        conn.commit()
 
     return redirect(url_for("home", error_description="You have been subscribed!"))
 
@@ -367,10 +381,11 @@ def consent2():
 
 @app.route(f"{URL_PREFIX}/user_home")
 @auth.requires_login
+@read_only
 def home():
     success = request.args.get("success")
     error = request.args.get("error_description")
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         subscription_repo = DbSubscriptionRepository(conn)
 
         is_subscribed = False
@@ -390,17 +405,11 @@ def home():
 @auth.requires_login
 def feedback():
     account_id = auth.get_account_id()
+    if request.method == "GET" and not request.args.get("feedbackType"):
+        mark_read_only()  # just viewing the newsletter
 
-    def fetch_images(image_repo, impressions):
-        images = {}
-        for impression in impressions:
-            if impression.preview_image_id:
-                images[impression.preview_image_id] = image_repo.fetch_image_by_id(impression.preview_image_id)
-        return images
-
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         newsletter_repo = DbNewsletterRepository(conn)
-        image_repo = DbImageRepository(conn)
 
         if request.method == "POST":
             if request.is_json:
@@ -417,7 +426,6 @@ def feedback():
                 is_article_positive = False
 
             newsletter_repo.store_impression_feedback(impression_id, is_article_positive)
-            conn.commit()
 
             if request.is_json:
                 return jsonify({"status": "ok", "feedback": is_article_positive})
@@ -428,18 +436,14 @@ def feedback():
 
         if feedbackType:
             newsletter_repo.store_newsletter_feedback(account_id, newsletter_id, feedbackType)
-            conn.commit()
-        newsletter = newsletter_repo.fetch_newsletter(newsletter_id)
-
-        # Fetch images for all impressions
-        newsletter = newsletter_repo.fetch_newsletter(newsletter_id)
-        all_impressions = newsletter.impressions if newsletter else []
-        images = fetch_images(image_repo, all_impressions)
+        newsletter, images = cached_newsletter_with_images(conn, newsletter_id)
+        impression_feedback = fetch_impression_feedback(conn, newsletter_id) if newsletter else {}
 
     return render_template(
         "feedback.html",
         newsletter=newsletter,
         images=images,
+        impression_feedback=impression_feedback,
     )
 
 
@@ -459,13 +463,13 @@ def update_preference_api():
     if not new_value:
         return jsonify({"error": "Missing data"}), 400
 
-    with DB_ENGINE.connect() as conn:
+    entity_id = topic_index.entity_id(topic_name)
+    if entity_id is None:
+        return jsonify({"error": "Topic not found"}), 404
+
+    with db_connection() as conn:
         repo = DbAccountInterestRepository(conn)
         account_id = auth.get_account_id()
-        entity_id = repo.fetch_entity_by_name(topic_name)
-
-        if entity_id is None:
-            return jsonify({"error": "Topic not found"}), 404
 
         acct_interest = AccountInterest(
             account_id=account_id,
@@ -477,11 +481,74 @@ def update_preference_api():
         )
 
         repo.store_topic_preferences(account_id, [acct_interest])
-        conn.commit()
 
     return jsonify({"status": "success"}), 200
 
 
+@app.route(f"{URL_PREFIX}/update-preferences", methods=["POST"])
+@auth.requires_login
+def update_preferences_api():
+    # batched update-topic-preference/update-entity-preference: {"changes": [{"topic": ..., "value": ...},
+    # {"entity": ..., "entity_type": ..., "value": ...}, ...]}, saved together or not at all
+    data = request.get_json(silent=True)
+    changes = data.get("changes") if isinstance(data, dict) else None
+    if not changes or not isinstance(changes, list):
+        return jsonify({"error": "Missing data"}), 400
+
+    # a slider dragged back and forth only needs its final position saved
+    latest = {}
+    for change in changes:
+        if not isinstance(change, dict) or "value" not in change:
+            return jsonify({"error": "Missing data"}), 400
+        try:
+            value = int(change["value"])
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid value"}), 400
+        if value < 1 or value > 5:
+            return jsonify({"error": "Value out of range"}), 400
+
+        if "topic" in change:
+            if change["topic"] not in GENERAL_TOPICS:
+                return jsonify({"error": "Unknown topic"}), 404
+            latest[("topic", change["topic"])] = value
+        elif "entity" in change:
+            if not auth.get_account_teams():  # team members only
+                return jsonify({"error": "forbidden"}), 403
+            entity_type = change.get("entity_type")
+            if entity_type not in ENTITY_PAGE_TYPES:
+                return jsonify({"error": "Invalid or missing entity_type"}), 400
+            latest[(entity_type, change["entity"])] = value
+        else:
+            return jsonify({"error": "Missing data"}), 400
+
+    with db_connection() as conn:
+        repo = DbAccountInterestRepository(conn)
+        account_id = auth.get_account_id()
+        interests = []
+        for (entity_type, name), value in latest.items():
+            if entity_type == "topic":
+                entity_id = topic_index.entity_id(name)
+            else:
+                entity_id = repo.fetch_entity_by_name(name, exclude_types=["topic", "subject"])
+            if entity_id is None:
+                return jsonify({"error": "Entity not found", "name": name}), 404
+            interests.append(
+                AccountInterest(
+                    account_id=account_id,
+                    entity_id=entity_id,
+                    entity_name=name,
+                    entity_type=entity_type,
+                    preference=value,
+                    frequency=None,
+                )
+            )
+
+        repo.store_topic_preferences(account_id, interests)
+        bump_account_versions(conn, [account_id])
+
+    return jsonify({"status": "success", "saved": len(interests)}), 200
+
+
 @app.route(f"{URL_PREFIX}/topics", methods=["GET", "POST"])
 @auth.requires_login
 def topics():
@@ -498,7 +565,7 @@ def topics():
     ]
 
     def get_topic_preferences(account_id):  # for geting user topic preference
-        with DB_ENGINE.connect() as conn:
+        with db_connection() as conn:
             repo = DbAccountInterestRepository(conn)
             preferences = repo.fetch_topic_preferences(account_id)
         preferences_dict = {pref.entity_name: pref.preference for pref in preferences}
@@ -513,12 +580,13 @@ def topics():
 
     updated = False
     if request.method == "POST":
-        with DB_ENGINE.connect() as conn:
+        with db_connection() as conn:
             repo = DbAccountInterestRepository(conn)
             account_id = auth.get_account_id()
             topic_prefs = []
+            topic_ids = topic_index.entity_ids()
             for topic in GENERAL_TOPICS:
-                entity_id = repo.fetch_entity_by_name(topic)
+                entity_id = topic_ids.get(topic)
                 if entity_id is None:
                     continue
                 score = get_pref(topic)
@@ -535,7 +603,6 @@ def topics():
                     )
 
             repo.store_topic_preferences(account_id, topic_prefs)
-            conn.commit()
             updated = True
 
             if onboarding:
@@ -560,6 +627,7 @@ def topics():
 
 @app.route(f"{URL_PREFIX}/entity-search", methods=["GET"])
 @auth.requires_login
+@read_only
 def entity_search():
     # autocomplete for the entities page -- topics/subjects excluded
     if not auth.get_account_teams():  # team members only
@@ -569,11 +637,11 @@ def entity_search():
     if len(query) < 2:
         return jsonify({"entities": []}), 200
 
-    with DB_ENGINE.connect() as conn:
-        repo = DbAccountInterestRepository(conn)
-        results = repo.fetch_entities_by_partial_name(query, limit=10, exclude_types=["topic", "subject"])
-
-    return jsonify(results), 200
+    etag = make_etag(entity_index.version(), fold(query))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    return with_etag(jsonify({"entities": entity_index.search(query, limit=10)}), etag)
 
 
 @app.route(f"{URL_PREFIX}/update-entity-preference", methods=["POST"])
@@ -604,7 +672,7 @@ def update_entity_preference_api():
     if new_value < 1 or new_value > 5:
         return jsonify({"error": "Value out of range"}), 400
 
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         repo = DbAccountInterestRepository(conn)
         account_id = auth.get_account_id()
         entity_id = repo.fetch_entity_by_name(entity_name, exclude_types=["topic", "subject"])
@@ -622,13 +690,14 @@ def update_entity_preference_api():
         )
 
         repo.store_topic_preferences(account_id, [acct_interest])
-        conn.commit()
+        bump_account_versions(conn, [account_id])
 
     return jsonify({"status": "success"}), 200
 
 
 @app.route(f"{URL_PREFIX}/entities", methods=["GET"])
 @auth.requires_experimenter  # team members only
+@read_only
 def entities():
     interest_lvls = [
         ("Strongly avoid", 1),
@@ -638,7 +707,7 @@ def entities():
         ("Strongly prefer", 5),
     ]
 
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         repo = DbAccountInterestRepository(conn)
         account_id = auth.get_account_id()
         user_entities = repo.fetch_entity_preferences(account_id, exclude_types=["topic", "subject"])
@@ -652,57 +721,41 @@ def entities():
 
 @app.route(f"{URL_PREFIX}/entity-suggestions", methods=["GET"])
 @auth.requires_login
+@read_only
 def entity_suggestions():
     if not auth.get_account_teams():  # team members only
         return jsonify({"error": "forbidden"}), 403
 
     account_id = auth.get_account_id()
-    suggestions = []
-    seen = set()
     source = "starter"  # "history" if from click data, else "starter"
 
-    with DB_ENGINE.connect() as conn:
+    # the account's version covers its ratings and click history. On the primary, since the
+    # first visit counts the clicks made before affinities were kept.
+    with db_connection(read_only=False) as primary:
+        ensure_seeded(primary, account_id)
+        etag = make_etag(account_id, fetch_account_version(primary, account_id), starter_entities.version())
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    with db_connection() as conn:
         interest_repo = DbAccountInterestRepository(conn)
-        click_repo = DbClicksRepository(conn)
-        article_repo = DbArticleRepository(conn)
 
         # skip entities the user already rated
         rated = interest_repo.fetch_entity_preferences(account_id, exclude_types=["topic", "subject"])
         rated_names = {r["entity_name"].lower() for r in rated}
 
-        # entities from the user's clicked articles, by frequency
-        account = Account(account_id=account_id, status="active")
-        clicks = click_repo.fetch_clicks([account]).get(account_id, [])
-        article_ids = list({click.article_id for click in clicks})[:50]
-        if article_ids:
-            articles = article_repo.fetch_article_mentions(article_repo.fetch_articles_by_id(article_ids))
-            counts = {}
-            for article in articles:
-                for mention in article.mentions:
-                    if mention.entity.entity_type not in ENTITY_PAGE_TYPES:
-                        continue
-                    name = mention.entity.name
-                    if name.lower() in rated_names:
-                        continue
-                    key = (name, mention.entity.entity_type)
-                    counts[key] = counts.get(key, 0) + 1
-            for (name, entity_type), _ in sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:12]:
-                suggestions.append({"name": name, "entity_type": entity_type})
-                seen.add(name.lower())
-            if suggestions:
-                source = "history"
-
-        # fallback for new users with no click history
-        if not suggestions:
-            sample = interest_repo.fetch_entities_by_partial_name("a", limit=20, exclude_types=["topic", "subject"])
-            for ent in sample.get("entities", []):
-                if ent["name"].lower() in rated_names or ent["name"].lower() in seen:
-                    continue
-                suggestions.append({"name": ent["name"], "entity_type": ent["entity_type"]})
-                if len(suggestions) >= 12:
-                    break
+    # entities from the user's clicked articles, by frequency
+    with db_connection(read_only=False) as primary:
+        suggestions = top_entities(primary, account_id, limit=12, exclude_names=rated_names)
+    if suggestions:
+        source = "history"
+
+    # fallback for new users with no click history: what's in the news lately
+    if not suggestions:
+        suggestions = starter_entities.get(limit=12, exclude_names=rated_names)
 
-    return jsonify({"suggestions": suggestions, "source": source}), 200
+    return with_etag(jsonify({"suggestions": suggestions, "source": source}), etag)
 
 
 @app.route(f"{URL_PREFIX}/demographic_survey", methods=["GET"])
@@ -731,7 +784,7 @@ def demographic_form():
 def update_demographics():
     onboarding = auth.get_account_status() == "pending_demographic_survey"
 
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         repo = DbDemographicsRepository(conn)
         account_repo = DbAccountRepository(conn)
         account_id = auth.get_account_id()
@@ -793,10 +846,9 @@ def update_demographics():
 
             repo.store_demographics(demo)
             account_repo.store_zip5(account_id, zip5)
-            conn.commit()
         if onboarding:
             finish_demographic_survey(account_id)
-            enqueue_newsletter_request(
+            newsletter_requests.request(
                 account_id=account_id,
                 profile_id=account_id,
                 group_id=None,
@@ -838,12 +890,13 @@ def compensation_preference_form():
     click_and_survey_activity = {}
 
     now = datetime.now(timezone.utc).astimezone()
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         compensation_repo = DbCompensationRepository(conn)
         compensation_period = compensation_repo.fetch_compensation_period_between(now, now)
 
         if compensation_period:
-            click_and_survey_activity = fetch_user_click_and_survey_activity(
+            click_and_survey_activity = get_activity_counts(
+                conn,
                 auth.get_account_id(),
                 compensation_period.start_date,
                 compensation_period.end_date,
@@ -867,7 +920,7 @@ def compensation_preference_form():
 def update_compensation_preference():
     onboarding = auth.get_account_status() == "pending_compensation_preference"
 
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account_id = auth.get_account_id()
 
@@ -881,11 +934,10 @@ def update_compensation_preference():
             compensation_choice = validate(compensation_method, COMPENSATION_OPTIONS)
 
         account_repo.store_compensation(account_id, compensation_choice)
-        conn.commit()
 
         if onboarding:
             finish_onboarding(account_id)
-            enqueue_newsletter_request(
+            newsletter_requests.request(
                 account_id=account_id,
                 profile_id=account_id,
                 group_id=None,
@@ -910,26 +962,39 @@ def track_email_click(path):
 
     headers = {k: v for k, v in request.headers.items()}  # convert to conventional dict
 
-    try:
-        with DB_ENGINE.connect() as conn:
-            click_repo = DbClicksRepository(conn)
-            click_repo.store_click(
-                params.newsletter_id, params.account_id, params.article_id, headers, impression_id=params.impression_id
-            )
-
-    except Exception:
-        logger.error(
-            "CLICK TRACKING FAILURE: Couldn't store click "
-            f"from newsletter {params.newsletter_id} on "
-            f"article {params.article_id}, redirecting anyway."
-        )
+    # buffered -- written to the database in bulk by a background thread
+    record_click(params, headers)
 
     return redirect(params.url)
 
 
+# served straight from memory -- email opens come in large bursts
+TRACKING_PIXEL = (Path(app.root_path) / "static" / "1x1.png").read_bytes()
+
+
+def tracking_pixel_response():
+    return Response(TRACKING_PIXEL, mimetype="image/png", headers={"Cache-Control": "no-store, max-age=0"})
+
+
 @app.route(f"{URL_PREFIX}/track_pixel")
 def track_pixel():
-    return send_file("static/1x1.png", max_age=0)
+    # unsigned pixel from older newsletters, nothing to record
+    return tracking_pixel_response()
+
+
+@app.route(f"{URL_PREFIX}/track_pixel/<path>")
+def track_open(path):
+    try:
+        params: OpenTrackingData = from_hashed_base64(path, HMAC_KEY, OpenTrackingData)
+    except ValueError as e:
+        # still serve the image, a broken pixel in someone's inbox helps nobody
+        logger.warning(f"Error processing open tracking pixel: {e}")
+        return tracking_pixel_response()
+
+    # buffered -- opens are folded together and upserted in bulk by a background thread
+    record_open(params)
+
+    return tracking_pixel_response()
 
 
 @app.route(f"{URL_PREFIX}/learn_more")
@@ -937,5 +1002,19 @@ def learn_more():
     return render_template("learn_more.html")
 
 
+@app.cli.command("replay-clicks")
+def replay_clicks_command():
+    """Load clicks spooled to local disk during database outages."""
+    replayed = replay_spooled_clicks()
+    print(f"replayed {replayed} clicks")
+
+
+@app.cli.command("create-web-tables")
+def create_web_tables_command():
+    """Create the tables poprox-web keeps alongside poprox-storage's, before the workers that use them start."""
+    create_web_tables(DB_ENGINE)
+    print("web tables are up to date")
+
+
 if __name__ == "__main__":
     app.run(debug=True)
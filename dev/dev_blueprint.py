@@ -5,7 +5,6 @@ from os import environ as env
 from pathlib import Path
 
 from flask import Blueprint, render_template, request, url_for
-from poprox_storage.aws import DB_ENGINE
 from poprox_storage.repositories.articles import DbArticleRepository
 from poprox_storage.repositories.images import DbImageRepository
 from poprox_storage.repositories.newsletters import DbNewsletterRepository
@@ -13,6 +12,8 @@ from poprox_storage.repositories.newsletters import DbNewsletterRepository
 from poprox_concepts.api.tracking import LoginLinkData, TrackingLinkData
 from poprox_concepts.domain.newsletter import Newsletter
 from util.auth import auth
+from util.newsletters import load_newsletter_with_images
+from util.postgres_db import db_connection, rollback_request_connection
 
 dev = Blueprint("dev", __name__, template_folder="templates", url_prefix="/dev")
 HMAC_KEY = env.get("POPROX_HMAC_KEY", "defaultpoproxhmackey")
@@ -48,7 +49,7 @@ def newsletter_loader_post():
     the_newsletter.account_id = auth.get_account_id()
     the_newsletter.treatment_id = None
     the_newsletter.experience_id = None
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         newsletter_repo = DbNewsletterRepository(conn)
         article_repo = DbArticleRepository(conn)
         image_repo = DbImageRepository(conn)
@@ -74,6 +75,7 @@ def newsletter_loader_post():
             conn.commit()
         except:  # noqa: E722
             print("WARNING -- IT DIDNT SAVE")
+            rollback_request_connection()
 
     return render_template(
         "newsletter_loader_post.html", url=url_for("feedback", newsletter_id=the_newsletter.newsletter_id)
@@ -130,19 +132,15 @@ def dev_decode():
         decode_vars["Newsletter Id"] = newsletter_id
     newsletter = None
 
-    with DB_ENGINE.connect() as conn:
-        newsletter_repo = DbNewsletterRepository(conn)
-        image_repo = DbImageRepository(conn)
-        newsletters = newsletter_repo.fetch_newsletters_by_id([newsletter_id])
+    with db_connection() as conn:
+        newsletter, images = load_newsletter_with_images(conn, newsletter_id)
 
-        if len(newsletters) > 0:
+        if newsletter is not None:
             decode_vars["Tried to find Newsletter"] = "dump shown below"
-            newsletter = newsletters[0]
 
             for impression in newsletter.impressions:
-                impression.article.images = []
-                image = image_repo.fetch_image_by_id(impression.preview_image_id)
-                impression.article.images.append(image)
+                image = images.get(impression.preview_image_id)
+                impression.article.images = [image] if image is not None else []
                 impression.article.preview_image_id = impression.preview_image_id
 
             newsletter = newsletter.model_dump_json(indent=2)
@@ -5,7 +5,6 @@ from uuid import uuid4
 import requests
 import stamina
 from flask import Blueprint, redirect, render_template, request, url_for
-from poprox_storage.aws import DB_ENGINE
 from poprox_storage.concepts.experiment import Recommender
 from poprox_storage.repositories.accounts import DbAccountRepository
 from poprox_storage.repositories.experience import DbExperiencesRepository
@@ -13,6 +12,14 @@ from poprox_storage.repositories.teams import DbTeamRepository
 
 from poprox_concepts.domain.experience import Experience
 from util.auth import auth
+from util.postgres_db import (
+    db_connection,
+    get_accounts,
+    notify_account_changed,
+    read_only,
+    release_request_connection,
+    rollback_request_connection,
+)
 
 exp = Blueprint("experimenter", __name__, template_folder="templates", url_prefix="/dash")
 EXPERENCE_TEST_URL = env.get("EXPERENCE_TEST_URL")
@@ -43,13 +50,13 @@ def expt_dashboard(experiment_id):
 @exp.get("/team/<team_id>")
 @exp.get("/team/<team_id>/members")
 @auth.requires_team_member
+@read_only
 def team_dash_members(team_id):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
-        account_repo = DbAccountRepository(conn)
         team = team_repo.fetch_team_by_id(team_id)
-        members = account_repo.fetch_accounts(team.members)
-        return render_template("team_dash_members.html", team=team, members=members)
+    members = get_accounts(team.members, include_teams=False)
+    return render_template("team_dash_members.html", team=team, members=members)
 
 
 ## TEAM EXPERIENCE SPECIFIC TASKS and endpoints
@@ -57,8 +64,9 @@ def team_dash_members(team_id):
 
 @exp.get("/team/<team_id>/experiences")
 @auth.requires_team_member
+@read_only
 def team_dash_experiences(team_id):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
         experience_repo = DbExperiencesRepository(conn)
         experiences = experience_repo.fetch_experiences_by_team(team_id)
@@ -77,7 +85,7 @@ def team_dash_experiences(team_id):
 @exp.get("/team/<team_id>/experiences/edit/<experience_id>")
 @auth.requires_team_member
 def team_edit_experience_form(team_id, experience_id=None, error=None):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
         experience_repo = DbExperiencesRepository(conn)
 
@@ -124,7 +132,7 @@ def team_edit_experience_post(team_id, experience_id=None):
 
         recommender_id = None
 
-        with DB_ENGINE.connect() as conn:
+        with db_connection() as conn:
             team_repo = DbTeamRepository(conn)
             experience_repo = DbExperiencesRepository(conn)
 
@@ -148,13 +156,13 @@ def team_edit_experience_post(team_id, experience_id=None):
                 template=template,
             )
             experience_repo.store_experience(experience)
-            conn.commit()
             return redirect(url_for("experimenter.team_dash_experiences", team_id=team_id))
 
     except Exception as e:
         # XXX: This swallows probably too many errors,
         # but given that errors might be caused by user-input here
         # I wanted to opt for feedback-over-logging.
+        rollback_request_connection()  # the form queries again, which an aborted transaction won't allow
         return team_edit_experience_form(team_id, experience_id, error=f"Unexpected Error {e}")
 
 
@@ -171,6 +179,9 @@ def team_experience_test_now(team_id, experience_id):
             )
         )
 
+    # the retries below can take minutes; don't hold a pooled connection open through them
+    release_request_connection()
+
     try:
         for attempt in stamina.retry_context(
             on=(requests.HTTPError, requests.RequestException),
@@ -208,7 +219,7 @@ def team_experience_test_now(team_id, experience_id):
 @auth.requires_team_member
 def add_to_team(team_id):
     email = request.form.get("email", "")
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         team_repo = DbTeamRepository(conn)
         account_repo = DbAccountRepository(conn)
         account = account_repo.fetch_account_by_email(email)
@@ -220,7 +231,8 @@ def add_to_team(team_id):
             )
         try:
             team_repo.insert_team_membership(team_id, account.account_id)
-            conn.commit()
+            notify_account_changed(account.account_id)
             return redirect(url_for("experimenter.team_dash_members", team_id=team_id))
         except ValueError as e:
+            rollback_request_connection()
             return redirect(url_for("experimenter.team_dash_members", team_id=team_id, error=str(e)))
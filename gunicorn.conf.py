@@ -0,0 +1,27 @@
+# gunicorn loads this automatically from the working directory.
+
+
+def post_worker_init(worker):
+    # send any emails and newsletter requests still spooled from before a restart
+    from util.email_outbox import email_outbox
+    from util.entity_index import entity_index, starter_entities
+    from util.newsletter_requests import newsletter_requests
+    from util.topic_index import topic_index
+
+    email_outbox.start()
+    newsletter_requests.start()
+    # so the first preference save or search doesn't pay for loading them
+    for index in (topic_index, entity_index, starter_entities):
+        try:
+            index.warm()
+        except Exception:
+            worker.log.exception("couldn't preload %s, will retry on first use", type(index).__name__)
+
+
+def worker_exit(server, worker):
+    # flush buffered clicks etc. before the worker goes away
+    from util.newsletter_requests import newsletter_requests
+    from util.write_buffer import close_all_buffers
+
+    close_all_buffers()
+    newsletter_requests.close()
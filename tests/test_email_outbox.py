@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from util import email_outbox as module
+from util.email_outbox import EmailOutbox, InMemoryEmailQueue
+from util.spool import Spool
+
+
+class FlakyQueue(InMemoryEmailQueue):
+    """Rejects every message addressed to `bad_address`, like SQS failing part of a batch."""
+
+    def __init__(self, bad_address) -> None:
+        super().__init__()
+        self.bad_address = bad_address
+
+    def send_message_batch(self, queue_url, entries) -> dict:
+        bad = [entry for entry in entries if json.loads(entry["MessageBody"])["email_to"] == self.bad_address]
+        good = [entry for entry in entries if entry not in bad]
+        super().send_message_batch(queue_url, good)
+        return {
+            "Successful": [{"Id": entry["Id"]} for entry in good],
+            "Failed": [{"Id": entry["Id"], "Code": "Throttled"} for entry in bad],
+        }
+
+
+@pytest.fixture
+def outbox_with(tmp_path, monkeypatch):
+    def make(queue, max_attempts=2):
+        outbox = EmailOutbox(Spool(tmp_path / "outbox.jsonl"), queue, max_attempts=max_attempts)
+        # dispatched by the test, not the background thread
+        monkeypatch.setattr(outbox, "start", lambda: None)
+        return outbox
+
+    return make
+
+
+def put_emails(outbox, *addresses):
+    for address in addresses:
+        outbox.put("https://queue", address, "Subject", f"<p>hi {address}</p>")
+
+
+def test_everything_is_sent(outbox_with):
+    queue = InMemoryEmailQueue()
+    outbox = outbox_with(queue)
+    put_emails(outbox, "a@example.com", "b@example.com")
+
+    assert outbox.dispatch() == 2
+    assert [json.loads(body)["email_to"] for _, body in queue.messages] == ["a@example.com", "b@example.com"]
+    assert not outbox.spool.has_pending()
+
+
+def test_failed_part_of_a_batch_is_retried_after_a_backoff_then_given_up_on(outbox_with, monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(module.time, "time", lambda: clock[0])
+    queue = FlakyQueue("bad@example.com")
+    outbox = outbox_with(queue, max_attempts=2)
+    put_emails(outbox, "a@example.com", "bad@example.com", "c@example.com")
+
+    assert outbox.dispatch() == 2
+    assert outbox.spool.has_pending()
+    assert outbox.stats()["retried"] == 1
+
+    # still backing off, so not sent again yet
+    assert outbox.dispatch() == 0
+    assert outbox.stats()["dead"] == 0
+
+    clock[0] += module.EMAIL_BACKOFF
+    assert outbox.dispatch() == 0
+    assert not outbox.spool.has_pending()
+    assert outbox.stats()["dead"] == 1
+
+    dead = [message for path in outbox._dead.claim() for message in outbox._dead.read(path)]
+    assert [json.loads(message["body"])["email_to"] for message in dead] == ["bad@example.com"]
+    assert dead[0]["attempts"] == 2
+    assert "dead_at" in dead[0]
+
+
+def test_old_dead_emails_are_pruned(outbox_with):
+    outbox = outbox_with(FlakyQueue("bad@example.com"), max_attempts=1)
+    put_emails(outbox, "bad@example.com")
+    outbox.dispatch()
+    assert outbox.prune_dead() == 0
+
+    records = [message for path in outbox._dead.claim() for message in outbox._dead.read(path)]
+    for path in outbox._dead.claim():
+        outbox._dead.release(path)
+    outbox._dead.append([{**message, "dead_at": 0} for message in records])
+
+    assert outbox.prune_dead() == 1
+    assert not outbox._dead.has_pending()
@@ -0,0 +1,54 @@
+from uuid import uuid4
+
+from util.entity_search import EntitySnapshot
+
+OBAMA, MICHELLE, FOUNDATION, OBAMACARE, PORTLAND = (uuid4() for _ in range(5))
+ENTITIES = {
+    OBAMA: ("Barack Obama", "person", 10),
+    MICHELLE: ("Michelle Obama", "person", 5),
+    FOUNDATION: ("Obama Foundation", "organization", 1),
+    PORTLAND: ("Portland", "place", 3),
+}
+
+
+def test_more_mentioned_entities_rank_first():
+    snapshot = EntitySnapshot(ENTITIES)
+    assert snapshot.search("obama", 10) == [OBAMA, MICHELLE, FOUNDATION]
+
+
+def test_short_queries_use_the_precomputed_prefixes():
+    snapshot = EntitySnapshot(ENTITIES)
+    assert snapshot.search("ob", 10) == [OBAMA, MICHELLE, FOUNDATION]
+    assert snapshot.search("ob", 2) == [OBAMA, MICHELLE]
+    assert snapshot.search("p", 10) == [PORTLAND]
+
+
+def test_any_word_can_start_a_match():
+    snapshot = EntitySnapshot(ENTITIES)
+    assert snapshot.search("michelle o", 10) == [MICHELLE]
+    assert snapshot.search("obama f", 10) == [FOUNDATION]
+    assert snapshot.search("foundation", 10) == [FOUNDATION]
+    assert snapshot.search("zzzz", 10) == []
+
+
+def test_shorter_names_win_ties():
+    tie_a, tie_b = uuid4(), uuid4()
+    snapshot = EntitySnapshot({tie_a: ("Paris Hilton", "person", 2), tie_b: ("Paris", "place", 2)})
+    assert snapshot.search("paris", 10) == [tie_b, tie_a]
+
+
+def test_adding_entities_matches_a_full_build():
+    added = {OBAMACARE: ("Obamacare", "organization", 7)}
+    extended = EntitySnapshot({**ENTITIES, **added}, base=EntitySnapshot(ENTITIES), added=added)
+    rebuilt = EntitySnapshot({**ENTITIES, **added})
+
+    for query in ("o", "oba", "obama", "obamac", "portland"):
+        assert extended.search(query, 10) == rebuilt.search(query, 10)
+    assert extended.search("obama", 10) == [OBAMA, OBAMACARE, MICHELLE, FOUNDATION]
+    assert extended.version == rebuilt.version
+
+
+def test_version_follows_the_data():
+    assert EntitySnapshot(ENTITIES).version == EntitySnapshot(dict(reversed(list(ENTITIES.items())))).version
+    changed = {**ENTITIES, PORTLAND: ("Portland", "place", 4)}
+    assert EntitySnapshot(changed).version != EntitySnapshot(ENTITIES).version
@@ -0,0 +1,145 @@
+from uuid import uuid4
+
+import pytest
+
+from util import newsletter_requests as module
+from util.newsletter_requests import NewsletterRequestDispatcher
+from util.spool import Spool
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(module.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def dispatcher_with(tmp_path, monkeypatch):
+    def make(send_fn, window=30.0, max_delay=300.0):
+        dispatcher = NewsletterRequestDispatcher(send_fn, Spool(tmp_path / "requests.jsonl"), window, max_delay)
+        # dispatched by the test, not the background thread
+        monkeypatch.setattr(dispatcher, "start", lambda: None)
+        return dispatcher
+
+    return make
+
+
+def test_requests_for_one_account_are_merged(dispatcher_with, clock):
+    sent = []
+    dispatcher = dispatcher_with(lambda **kwargs: sent.append(kwargs))
+    account_id = uuid4()
+
+    dispatcher.request(account_id, profile_id=account_id, api_version="5.0")
+    clock.now += 5
+    dispatcher.request(account_id, profile_id=account_id, recommender_url="https://recs")
+    assert dispatcher.dispatch() == 0
+
+    clock.now += 31
+    assert dispatcher.dispatch() == 1
+    assert sent == [
+        {
+            "account_id": str(account_id),
+            "profile_id": str(account_id),
+            "api_version": "5.0",
+            "recommender_url": "https://recs",
+        }
+    ]
+    assert dispatcher.stats()["collapsed"] == 1
+
+
+def test_each_request_restarts_the_window_up_to_the_max_delay(dispatcher_with, clock):
+    sent = []
+    dispatcher = dispatcher_with(lambda **kwargs: sent.append(kwargs), window=30.0, max_delay=100.0)
+    account_id = uuid4()
+
+    for _ in range(4):
+        dispatcher.request(account_id)
+        clock.now += 20
+        dispatcher.dispatch()
+    assert sent == []
+
+    dispatcher.request(account_id)
+    clock.now += 25
+    assert dispatcher.dispatch() == 1
+
+
+def test_different_accounts_are_sent_separately(dispatcher_with, clock):
+    sent = []
+    dispatcher = dispatcher_with(lambda **kwargs: sent.append(kwargs["account_id"]))
+    first, second = uuid4(), uuid4()
+    dispatcher.request(first)
+    dispatcher.request(second)
+
+    assert dispatcher.dispatch(force=True) == 2
+    assert sorted(sent) == sorted([str(first), str(second)])
+
+
+def test_failed_sends_back_off_before_retrying(dispatcher_with, clock):
+    attempts = []
+
+    def flaky(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) <= 2:
+            raise RuntimeError("queue unavailable")
+
+    dispatcher = dispatcher_with(flaky, window=0.0)
+    dispatcher.request(uuid4())
+
+    assert dispatcher.dispatch() == 0
+    assert dispatcher.dispatch() == 0
+    assert len(attempts) == 1
+
+    clock.now += module.NEWSLETTER_REQUEST_BACKOFF
+    assert dispatcher.dispatch() == 0
+    clock.now += module.NEWSLETTER_REQUEST_BACKOFF
+    assert dispatcher.dispatch() == 0
+    assert len(attempts) == 2
+
+    clock.now += module.NEWSLETTER_REQUEST_BACKOFF * 2
+    assert dispatcher.dispatch() == 1
+    assert dispatcher.stats()["retried"] == 2
+    assert dispatcher.stats()["dead"] == 0
+
+
+def test_requests_that_keep_failing_are_dead_lettered(dispatcher_with, clock):
+    def down(**kwargs):
+        raise RuntimeError("queue unavailable")
+
+    dispatcher = dispatcher_with(down, window=0.0)
+    dispatcher.request(uuid4())
+    for _ in range(module.NEWSLETTER_REQUEST_ATTEMPTS):
+        dispatcher.dispatch()
+        clock.now += module.NEWSLETTER_REQUEST_MAX_BACKOFF
+
+    assert not dispatcher.spool.has_pending()
+    assert dispatcher.stats()["dead"] == 1
+    dead = Spool(str(dispatcher.spool.path) + ".dead")
+    assert [record["attempts"] for path in dead.claim() for record in dead.read(path)] == [
+        module.NEWSLETTER_REQUEST_ATTEMPTS
+    ]
+
+
+def test_close_leaves_pending_requests_for_the_next_worker(dispatcher_with, clock):
+    sent = []
+    dispatcher = dispatcher_with(lambda **kwargs: sent.append(kwargs))
+    dispatcher.request(uuid4())
+    dispatcher.close()
+
+    assert sent == []
+    assert dispatcher.spool.has_pending()
+
+
+def test_pending_requests_survive_a_new_dispatcher(dispatcher_with, clock):
+    dispatcher_with(lambda **kwargs: None).request(uuid4())
+    sent = []
+    assert dispatcher_with(lambda **kwargs: sent.append(kwargs)).dispatch(force=True) == 1
+    assert len(sent) == 1
@@ -0,0 +1,51 @@
+from util.scanner_detection import ScannerDetector
+
+BROWSER = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_0) AppleWebKit/605.1.15 Safari/605.1.15"}
+
+
+def test_one_reader_clicking_a_few_links_is_human():
+    detector = ScannerDetector(window=10.0, burst=4)
+    for i, now in enumerate([0.0, 30.0, 60.0, 90.0]):
+        assert detector.check("acct", "nl", f"imp{i}", BROWSER, now=now) is None
+
+
+def test_many_links_within_the_window_is_a_burst():
+    detector = ScannerDetector(window=10.0, burst=4)
+    reasons = [detector.check("acct", "nl", f"imp{i}", BROWSER, now=i * 0.5) for i in range(4)]
+    assert reasons == [None, None, None, "burst"]
+    assert detector.stats()["suspected"] == {"burst": 1}
+
+
+def test_the_same_link_twice_doesnt_count_towards_a_burst():
+    detector = ScannerDetector(window=10.0, burst=3)
+    for now in range(5):
+        assert detector.check("acct", "nl", "imp0", BROWSER, now=float(now)) is None
+
+
+def test_clicks_older_than_the_window_drop_out():
+    detector = ScannerDetector(window=10.0, burst=3)
+    detector.check("acct", "nl", "imp0", BROWSER, now=0.0)
+    detector.check("acct", "nl", "imp1", BROWSER, now=1.0)
+    assert detector.check("acct", "nl", "imp2", BROWSER, now=20.0) is None
+
+
+def test_bursts_are_counted_per_account_and_newsletter():
+    detector = ScannerDetector(window=10.0, burst=2)
+    assert detector.check("a", "nl", "imp0", BROWSER, now=0.0) is None
+    assert detector.check("b", "nl", "imp1", BROWSER, now=0.1) is None
+    assert detector.check("a", "other", "imp2", BROWSER, now=0.2) is None
+    assert detector.check("a", "nl", "imp3", BROWSER, now=0.3) == "burst"
+
+
+def test_stale_keys_are_forgotten():
+    detector = ScannerDetector(window=10.0, burst=4)
+    detector.check("a", "nl", "imp0", BROWSER, now=0.0)
+    detector.check("b", "nl", "imp0", BROWSER, now=100.0)
+    assert detector.stats()["tracked_keys"] == 1
+
+
+def test_headers_alone_can_give_a_scanner_away():
+    detector = ScannerDetector()
+    assert detector.check("a", "nl", "imp0", {"Sec-Purpose": "prefetch"}, now=0.0) == "prefetch"
+    assert detector.check("a", "nl", "imp1", {}, now=0.0) == "no-user-agent"
+    assert detector.check("a", "nl", "imp2", {"User-Agent": "Barracuda Sentinel"}, now=0.0) == "scanner-agent"
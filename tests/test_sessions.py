@@ -0,0 +1,98 @@
+import pytest
+from flask import Flask, session
+
+from util.sessions import make_session_interface, rotate_session_id
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__, static_folder=tmp_path, static_url_path="/static")
+    app.secret_key = "test-secret"
+    app.session_interface = make_session_interface("memory", None)
+
+    @app.get("/set/<value>")
+    def set_value(value):
+        session["value"] = value
+        return "ok"
+
+    @app.get("/get")
+    def get_value():
+        return session.get("value", "")
+
+    @app.get("/login")
+    def login():
+        rotate_session_id(session)
+        session["account"] = "acct"
+        return "ok"
+
+    @app.get("/logout")
+    def logout():
+        session.clear()
+        return "ok"
+
+    return app
+
+
+def store_of(app):
+    return app.session_interface.store._sessions
+
+
+def test_session_data_stays_on_the_server(app):
+    client = app.test_client()
+    response = client.get("/set/secret-value")
+
+    assert "secret-value" not in response.headers["Set-Cookie"]
+    assert client.get("/get").text == "secret-value"
+    assert len(store_of(app)) == 1
+
+
+def test_empty_sessions_arent_stored(app):
+    client = app.test_client()
+    response = client.get("/get")
+
+    assert "Set-Cookie" not in response.headers
+    assert store_of(app) == {}
+
+
+def test_tampered_cookie_starts_a_new_session(app):
+    client = app.test_client()
+    client.get("/set/secret-value")
+    cookie = client.get_cookie("session")
+    client.set_cookie("session", cookie.value[:-2] + "xx")
+
+    assert client.get("/get").text == ""
+
+
+def test_login_moves_the_session_to_a_new_id(app):
+    client = app.test_client()
+    client.get("/set/before-login")
+    before = set(store_of(app))
+    client.get("/login")
+    after = set(store_of(app))
+
+    assert len(after) == 1
+    assert before.isdisjoint(after)
+    assert client.get("/get").text == "before-login"
+
+
+def test_clearing_the_session_deletes_it(app):
+    client = app.test_client()
+    client.get("/set/value")
+    client.get("/logout")
+
+    assert store_of(app) == {}
+    assert client.get("/get").text == ""
+
+
+def test_static_files_dont_load_the_session(app):
+    client = app.test_client()
+    client.get("/set/value")
+    loads = []
+    store = app.session_interface.store
+    original_load = store.load
+    store.load = lambda session_id: loads.append(session_id) or original_load(session_id)
+
+    client.get("/static/missing.css")
+    assert loads == []
+    client.get("/get")
+    assert len(loads) == 1
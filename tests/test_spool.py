@@ -0,0 +1,80 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+from util.spool import Spool
+
+
+def test_claimed_records_come_back_in_order(tmp_path):
+    spool = Spool(tmp_path / "clicks.jsonl")
+    spool.append([{"n": 1}, {"n": 2}])
+    spool.append([{"n": 3}])
+
+    claimed = spool.claim()
+    assert len(claimed) == 1
+    assert spool.read(claimed[0]) == [{"n": 1}, {"n": 2}, {"n": 3}]
+
+    spool.release(claimed[0])
+    assert not spool.has_pending()
+    assert spool.claim() == []
+
+
+def test_appends_during_a_claim_land_in_a_new_file(tmp_path):
+    spool = Spool(tmp_path / "clicks.jsonl")
+    spool.append([{"n": 1}])
+    first = spool.claim()
+    spool.append([{"n": 2}])
+
+    claimed = spool.claim()
+    assert set(first) < set(claimed)
+    assert sorted(record["n"] for path in claimed for record in spool.read(path)) == [1, 2]
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    spool = Spool(tmp_path / "clicks.jsonl")
+    spool.append([{"n": 1}])
+    with open(spool.path, "a") as spool_file:
+        spool_file.write('{"n": 2')
+
+    claimed = spool.claim()
+    assert spool.read(claimed[0]) == [{"n": 1}]
+
+
+def _claim_and_die(path):
+    spool = Spool(path)
+    spool.append([{"n": 1}])
+    spool.claim()
+    # exits without releasing, like a worker killed mid-replay
+
+
+def test_files_claimed_by_a_dead_process_are_replayed(tmp_path):
+    path = tmp_path / "clicks.jsonl"
+    child = multiprocessing.get_context("fork").Process(target=_claim_and_die, args=(path,))
+    child.start()
+    child.join()
+
+    spool = Spool(path)
+    assert spool.has_pending()
+    claimed = spool.claim()
+    assert len(claimed) == 1
+    assert f"-{child.pid}-" in claimed[0].name
+    assert spool.read(claimed[0]) == [{"n": 1}]
+
+
+def test_files_claimed_by_a_live_process_are_left_alone(tmp_path):
+    spool = Spool(tmp_path / "clicks.jsonl")
+    with subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"]) as other:
+        try:
+            (tmp_path / f"clicks.jsonl.claimed-{other.pid}-abcd").write_text('{"n": 1}\n')
+            assert spool.claim() == []
+        finally:
+            other.kill()
+    other.wait()
+    assert len(spool.claim()) == 1
+
+
+def test_own_claims_are_returned_again(tmp_path):
+    spool = Spool(tmp_path / "clicks.jsonl")
+    (tmp_path / f"clicks.jsonl.claimed-{os.getpid()}-abcd").write_text('{"n": 1}\n')
+    assert len(spool.claim()) == 1
@@ -0,0 +1,72 @@
+import threading
+
+from util.write_buffer import PeriodicTask, WriteBuffer
+
+
+def make_buffer(flush_fn, **kwargs):
+    # a long interval, so only the test decides when to flush
+    return WriteBuffer("test", flush_fn, flush_interval=60.0, **kwargs)
+
+
+def test_flush_hands_over_everything_pending():
+    batches = []
+    buffer = make_buffer(batches.append)
+    for i in range(3):
+        assert buffer.add(i)
+
+    assert buffer.flush() == 3
+    assert batches == [[0, 1, 2]]
+    assert buffer.flush() == 0
+    assert buffer.stats()["flushed"] == 3
+    buffer.close()
+
+
+def test_full_buffer_flushes_without_waiting_for_the_interval():
+    flushed = threading.Event()
+    buffer = make_buffer(lambda batch: flushed.set(), max_items=2)
+    buffer.add("a")
+    buffer.add("b")
+
+    assert flushed.wait(5)
+    buffer.close()
+
+
+def test_failed_flush_goes_to_the_error_handler():
+    def fail(batch):
+        raise RuntimeError("database is down")
+
+    spooled = []
+    buffer = make_buffer(fail, on_error=spooled.extend)
+    buffer.add({"click": 1})
+    buffer.add({"click": 2})
+    buffer.flush()
+
+    assert spooled == [{"click": 1}, {"click": 2}]
+    assert buffer.stats()["failed"] == 2
+    assert buffer.stats()["flushed"] == 0
+    buffer.close()
+
+
+def test_items_past_max_pending_are_dropped():
+    buffer = make_buffer(lambda batch: None, max_pending=2)
+    assert buffer.add(1)
+    assert buffer.add(2)
+    assert not buffer.add(3)
+    assert buffer.stats()["dropped"] == 1
+    buffer.close()
+
+
+def test_periodic_task_keeps_running_after_a_failure():
+    calls = []
+    ran_twice = threading.Event()
+
+    def fn():
+        calls.append(1)
+        if len(calls) >= 2:
+            ran_twice.set()
+        raise RuntimeError("boom")
+
+    task = PeriodicTask("test", fn, 0.01)
+    task.ensure_started()
+    assert ran_twice.wait(5)
+    task.stop()
@@ -0,0 +1,155 @@
+from datetime import datetime, timedelta, timezone
+from os import environ as env
+
+from poprox_storage.repositories.compensation import DbCompensationRepository
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from util.postgres_db import fetch_user_click_and_survey_activity
+from util.scanner_detection import SCANNER_HEADER
+from util.tables import web_table
+
+# how often an account's counts are recounted from scratch. Clicks are added as they land, but survey responses
+# are loaded by another service, and filter_click_histories can rule out clicks the running count let in.
+ACTIVITY_COUNTER_RECONCILE_INTERVAL = timedelta(seconds=float(env.get("ACTIVITY_COUNTER_RECONCILE_INTERVAL", 60 * 60)))
+
+
+def get_activity_counts(conn, account_id, period_start, period_end) -> dict:
+    """The account's click and survey counts for a compensation period, usually one row read.
+
+    Clicks are added to the stored counts as they are stored
+    (`count_new_clicks`). The full computation
+    (`fetch_user_click_and_survey_activity`) only runs the first time, and
+    then once every ACTIVITY_COUNTER_RECONCILE_INTERVAL to pick up survey
+    responses and correct the click count.
+    """
+    counters_table = web_table("web_activity_counters")
+    key = (
+        (counters_table.c.account_id == account_id)
+        & (counters_table.c.period_start == period_start)
+        & (counters_table.c.period_end == period_end)
+    )
+    row = conn.execute(select(counters_table).where(key)).first()
+    now = datetime.now(timezone.utc)
+    if row is not None and now - row.reconciled_at < ACTIVITY_COUNTER_RECONCILE_INTERVAL:
+        return {"click_count": row.click_count, "survey_count": row.survey_count}
+    return _reconcile(conn, row, account_id, period_start, period_end, now)
+
+
+def count_new_clicks(conn, clicks) -> None:
+    """Add the newsletters in a batch of newly stored clicks to their accounts' current click counts.
+
+    Only clicks in the current compensation period count, each newsletter once
+    per account, and only for accounts whose counts have been computed before;
+    the others are counted in full when first shown. Clicks tagged as scanner
+    traffic are left out.
+    """
+    now = datetime.now(timezone.utc).astimezone()
+    period = DbCompensationRepository(conn).fetch_compensation_period_between(now, now)
+    if period is None:
+        return
+
+    pairs = {
+        (click["account_id"], click["newsletter_id"])
+        for click in clicks
+        if click.get("account_id")
+        and click.get("newsletter_id")
+        and SCANNER_HEADER not in (click.get("headers") or {})
+        and _in_period(period, click["created_at"])
+    }
+    if not pairs:
+        return
+
+    seen_table = web_table("web_activity_counted_newsletters")
+    new_pairs = conn.execute(
+        insert(seen_table)
+        .values(
+            [
+                {
+                    "account_id": account_id,
+                    "period_start": period.start_date,
+                    "period_end": period.end_date,
+                    "newsletter_id": newsletter_id,
+                }
+                for account_id, newsletter_id in pairs
+            ]
+        )
+        .on_conflict_do_nothing()
+        .returning(seen_table.c.account_id)
+    ).all()
+    if not new_pairs:
+        return
+
+    new_by_account = {}
+    for (account_id,) in new_pairs:
+        new_by_account[account_id] = new_by_account.get(account_id, 0) + 1
+
+    counters_table = web_table("web_activity_counters")
+    conn.execute(
+        update(counters_table)
+        .where(
+            (counters_table.c.account_id == bindparam("b_account_id"))
+            & (counters_table.c.period_start == period.start_date)
+            & (counters_table.c.period_end == period.end_date)
+        )
+        .values(
+            click_count=counters_table.c.click_count + bindparam("b_new"),
+            changes=counters_table.c.changes + 1,
+        ),
+        [{"b_account_id": account_id, "b_new": n} for account_id, n in new_by_account.items()],
+    )
+
+
+def _reconcile(conn, row, account_id, period_start, period_end, now):
+    changes = row.changes if row is not None else 0
+    counts = fetch_user_click_and_survey_activity(account_id, period_start, period_end)
+
+    if counts["clicked_newsletters"]:
+        seen_table = web_table("web_activity_counted_newsletters")
+        conn.execute(
+            insert(seen_table)
+            .values(
+                [
+                    {
+                        "account_id": account_id,
+                        "period_start": period_start,
+                        "period_end": period_end,
+                        "newsletter_id": newsletter_id,
+                    }
+                    for newsletter_id in counts["clicked_newsletters"]
+                ]
+            )
+            .on_conflict_do_nothing()
+        )
+
+    counters_table = web_table("web_activity_counters")
+    stmt = insert(counters_table).values(
+        account_id=account_id,
+        period_start=period_start,
+        period_end=period_end,
+        click_count=counts["click_count"],
+        survey_count=counts["survey_count"],
+        changes=changes,
+        reconciled_at=now,
+    )
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[counters_table.c.account_id, counters_table.c.period_start, counters_table.c.period_end],
+            set_={
+                "click_count": stmt.excluded.click_count,
+                "survey_count": stmt.excluded.survey_count,
+                "reconciled_at": stmt.excluded.reconciled_at,
+            },
+            # clicks counted while this ran aren't in `counts`; keep the running total and recount next time
+            where=counters_table.c.changes == changes,
+        )
+    )
+    return {"click_count": counts["click_count"], "survey_count": counts["survey_count"]}
+
+
+def _in_period(period, when) -> bool:
+    start, end = period.start_date, period.end_date
+    if not isinstance(start, datetime):
+        # periods given as whole days
+        when = when.date()
+    return start <= when <= end
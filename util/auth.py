@@ -1,17 +1,23 @@
-import json
 import logging
 from datetime import datetime, timezone
 from functools import wraps
 from os import environ as env
 
-import jinja2
-from flask import redirect, request, session, url_for
-from poprox_storage.aws import sqs
+from flask import g, has_request_context, redirect, request, session, url_for
 from werkzeug.wrappers import Response
 
 from poprox_concepts.api.tracking import SignUpLinkData, to_hashed_base64
 from util.config import require_secret
-from util.postgres_db import create_token, get_account, get_account_by_email, get_or_make_account
+from util.email_outbox import email_outbox
+from util.email_rendering import render_enroll_token_email, render_post_consent_email
+from util.postgres_db import (
+    create_token,
+    get_account,
+    get_account_by_email,
+    get_or_make_account,
+    on_account_changed,
+)
+from util.sessions import rotate_session_id
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -35,20 +41,33 @@ STATUS_REDIRECTS = {
 
 class Auth:
     def __init__(self) -> None:
-        pass
+        on_account_changed(self.invalidate_account_info)
 
     def enroll(self, email, source, subsource) -> Response:
+        rotate_session_id(session)
         session["account"] = get_or_make_account(email, source, subsource)
         return redirect(url_for(STATUS_REDIRECTS.get(self.get_account_status(), "home")))
 
     def login_via_account_id(self, account_id):
+        rotate_session_id(session)
         session["account"] = get_account(account_id)
+        g.account_refreshed = True
 
     def is_logged_in(self):
         return "account" in session
 
     def refresh_account_info(self):
-        session["account"] = get_account(self.get_account_id())
+        # at most once per request -- the finish_* helpers invalidate it when they change the account
+        if g.get("account_refreshed"):
+            return
+        account = get_account(self.get_account_id())
+        if account != session.get("account"):  # don't re-sign the cookie for nothing
+            session["account"] = account
+        g.account_refreshed = True
+
+    def invalidate_account_info(self, account_id=None):
+        if has_request_context():
+            g.pop("account_refreshed", None)
 
     def get_source(self):
         if self.is_logged_in():
@@ -204,25 +223,12 @@ class Auth:
         )
         link_data_signed = to_hashed_base64(link_data, HMAC_KEY)
 
-        jinja_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader("email_templates"),
-            autoescape=jinja2.select_autoescape(),
-        )
-
-        template = jinja_env.get_template("enroll_token_email.html")
         enroll_link_with_code = url_for(
             "enroll_with_token", link_data_raw=link_data_signed, code=token.code, _external=True
         )
-        html = template.render(enroll_link=enroll_link_with_code, token=token)
-        message = json.dumps(
-            {
-                "email_to": email,
-                "email_subject": "Confirm your POPROX email address",
-                "email_body": html,
-            }
-        )
+        html = render_enroll_token_email(enroll_link_with_code, token)
         if queue_url:
-            sqs.send_message(queue_url=queue_url, message_body=message)
+            email_outbox.put(queue_url, email, "Confirm your POPROX email address", html)
         else:
             logger.error("No email queue url is sent. This is OK in development.")
             logger.error("to: " + email)
@@ -239,24 +245,9 @@ class Auth:
         queue_url = env.get("SEND_EMAIL_QUEUE_URL")
         email = self.get_email()
 
-        jinja_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader("email_templates"),
-            autoescape=jinja2.select_autoescape(),
-        )
-
-        template = jinja_env.get_template("enroll_post_consent.html")
-        html = template.render(
-            consent_form_link=url_for("static", filename="Subscriber_Agreement_v2.pdf", _external=True)
-        )
-        message = json.dumps(
-            {
-                "email_to": email,
-                "email_subject": "Welcome to POPROX",
-                "email_body": html,
-            }
-        )
+        html = render_post_consent_email()
         if queue_url:
-            sqs.send_message(queue_url=queue_url, message_body=message)
+            email_outbox.put(queue_url, email, "Welcome to POPROX", html)
         else:
             logger.error("No email queue url is sent. This is OK in development.")
             logger.error("to: " + email)
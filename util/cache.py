@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+
+# every cache created in this process, for the admin stats endpoint
+CACHES = []
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire `ttl` seconds after they are set.
+
+    This is per worker process: writes made by another worker are only seen
+    once the entry expires, unless something invalidates it explicitly.
+    """
+
+    def __init__(self, name, max_size, ttl) -> None:
+        self.name = name
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        CACHES.append(self)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+
+def cache_stats() -> dict:
+    return {cache.name: cache.stats() for cache in CACHES}
@@ -0,0 +1,17 @@
+from os import environ as env
+
+from util.scanner_detection import SCANNER_HEADER
+
+DEFAULT_ALLOWLIST = (
+    "User-Agent,Accept-Language,Referer,X-Forwarded-For,"
+    "Sec-Fetch-Site,Sec-Fetch-Mode,Sec-Fetch-Dest,Sec-Fetch-User,"
+    "Purpose,Sec-Purpose,X-Purpose,X-Moz"
+)
+CLICK_HEADER_ALLOWLIST = {
+    name.strip().lower() for name in env.get("CLICK_HEADER_ALLOWLIST", DEFAULT_ALLOWLIST).split(",") if name.strip()
+}
+CLICK_HEADER_ALLOWLIST.add(SCANNER_HEADER.lower())
+
+
+def allowed_headers(headers: dict) -> dict:
+    return {name: value for name, value in headers.items() if name.lower() in CLICK_HEADER_ALLOWLIST}
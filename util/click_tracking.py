@@ -0,0 +1,240 @@
+import json
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from os import environ as env
+from uuid import UUID, uuid4
+
+from sqlalchemy import cast, func, literal, text, update
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+from poprox_concepts.api.tracking import TrackingLinkData
+from util.activity_counters import count_new_clicks
+from util.click_headers import allowed_headers
+from util.entity_affinity import count_clicked_articles
+from util.postgres_db import DB_ENGINE
+from util.scanner_detection import CLICK_SCANNER_MODE, CLICK_SCANNER_WINDOW, SCANNER_HEADER, scanner_detector
+from util.spool import Spool
+from util.tables import rows_for, storage_table
+from util.write_buffer import PeriodicTask, WriteBuffer
+
+logger = logging.getLogger(__name__)
+
+CLICK_BUFFER_SIZE = int(env.get("CLICK_BUFFER_SIZE", 200))
+CLICK_BUFFER_INTERVAL = float(env.get("CLICK_BUFFER_INTERVAL", 2.0))
+CLICK_SPOOL_PATH = env.get("CLICK_SPOOL_PATH", "spool/clicks.jsonl")
+CLICK_REPLAY_INTERVAL = float(env.get("CLICK_REPLAY_INTERVAL", 60.0))
+CLICK_REPLAY_BATCH_SIZE = 500
+CLICK_MAX_REPLAY_ATTEMPTS = int(env.get("CLICK_MAX_REPLAY_ATTEMPTS", 10))
+
+UUID_FIELDS = ("click_id", "account_id", "newsletter_id", "article_id", "impression_id")
+
+click_spool = Spool(CLICK_SPOOL_PATH)
+# clicks that kept failing to store, kept for a person to look at
+dead_click_spool = Spool(CLICK_SPOOL_PATH + ".dead")
+_replay_lock = threading.Lock()
+
+
+def _uuid_or_none(value):
+    if value is None or value == "None":
+        return None
+    return UUID(str(value))
+
+
+def _decode_click(record: dict) -> dict:
+    click = dict(record)
+    for field in UUID_FIELDS:
+        click[field] = _uuid_or_none(click.get(field))
+    if click.get("created_at"):
+        click["created_at"] = datetime.fromisoformat(click["created_at"])
+    return click
+
+
+def store_clicks(clicks: list[dict]) -> None:
+    """Insert a batch of clicks with a single multi-row insert.
+
+    Every click carries a click_id generated when it was recorded, so storing
+    the same click twice (e.g. replaying the spool after a partial failure) is
+    a no-op rather than a double count. The clicked articles are added to the
+    accounts' entity affinities, and the clicked newsletters to their activity
+    counters, in the same transaction; if either of those fails it is logged and
+    the clicks are stored anyway.
+
+    A scanner burst is only noticed on its last click, so the clicks before it
+    in the same window are tagged with SCANNER_HEADER here, whether they are in
+    this batch or were stored by an earlier one.
+    """
+    with DB_ENGINE.connect() as conn:
+        clicks_table = storage_table(conn, "clicks")
+        if "click_id" not in clicks_table.c:
+            # rows_for would quietly drop it, and with it the only thing that makes storing a click idempotent
+            raise RuntimeError("clicks table has no click_id column, so replayed clicks can't be deduplicated")
+        _tag_earlier_burst_clicks(clicks)
+        conn.execute(insert(clicks_table).on_conflict_do_nothing(), rows_for(clicks_table, clicks))
+        try:
+            with conn.begin_nested():
+                _tag_stored_burst_clicks(conn, clicks_table, clicks)
+        except Exception:
+            logger.exception("couldn't tag the clicks leading up to a scanner burst")
+        try:
+            # in a savepoint, so a problem keeping affinities up to date can't cost us the clicks themselves
+            with conn.begin_nested():
+                count_clicked_articles(conn, clicks)
+        except Exception:
+            logger.exception(f"couldn't update entity affinities for {len(clicks)} clicks")
+        try:
+            with conn.begin_nested():
+                count_new_clicks(conn, clicks)
+        except Exception:
+            # the counts then catch up at the account's next reconcile
+            logger.exception(f"couldn't add {len(clicks)} clicks to activity counters")
+        conn.commit()
+
+
+def _burst_key(click):
+    return (click["account_id"], click["newsletter_id"], (click.get("headers") or {}).get("User-Agent", ""))
+
+
+def _burst_clicks(clicks):
+    return [click for click in clicks if (click.get("headers") or {}).get(SCANNER_HEADER) == "burst"]
+
+
+def _tag_earlier_burst_clicks(clicks):
+    window = timedelta(seconds=CLICK_SCANNER_WINDOW)
+    for burst in _burst_clicks(clicks):
+        for click in clicks:
+            if (
+                SCANNER_HEADER not in (click.get("headers") or {})
+                and _burst_key(click) == _burst_key(burst)
+                and burst["created_at"] - window <= click["created_at"] < burst["created_at"]
+            ):
+                click["headers"] = {**(click.get("headers") or {}), SCANNER_HEADER: "burst"}
+
+
+def _tag_stored_burst_clicks(conn, clicks_table, clicks):
+    headers = cast(clicks_table.c.headers, JSONB)
+    tagged = func.coalesce(headers, cast(literal("{}"), JSONB)).op("||")(
+        cast(literal(json.dumps({SCANNER_HEADER: "burst"})), JSONB)
+    )
+    for burst in _burst_clicks(clicks):
+        account_id, newsletter_id, user_agent = _burst_key(burst)
+        conn.execute(
+            update(clicks_table)
+            .where(
+                (clicks_table.c.account_id == account_id)
+                & (clicks_table.c.newsletter_id == newsletter_id)
+                & (clicks_table.c.created_at >= burst["created_at"] - timedelta(seconds=CLICK_SCANNER_WINDOW))
+                & (clicks_table.c.created_at < burst["created_at"])
+                & (func.coalesce(headers["User-Agent"].astext, "") == user_agent)
+                & headers[SCANNER_HEADER].astext.is_(None)
+            )
+            .values(headers=cast(tagged, clicks_table.c.headers.type))
+        )
+
+
+def spool_clicks(clicks: list[dict]) -> None:
+    logger.error(f"CLICK TRACKING FAILURE: Couldn't store {len(clicks)} clicks, spooling to {CLICK_SPOOL_PATH}.")
+    click_spool.append(clicks)
+    _replay_task.ensure_started()
+
+
+click_buffer = WriteBuffer(
+    "clicks",
+    store_clicks,
+    max_items=CLICK_BUFFER_SIZE,
+    flush_interval=CLICK_BUFFER_INTERVAL,
+    on_error=spool_clicks,
+)
+
+
+def record_click(params: TrackingLinkData, headers: dict) -> None:
+    """Queue a click for the next bulk insert. The click time is taken now, not when it is flushed.
+
+    Clicks that look like they came from an email scanner are tagged with
+    SCANNER_HEADER, or not stored at all when CLICK_SCANNER_MODE is "drop".
+    Only the headers in CLICK_HEADER_ALLOWLIST are kept.
+    """
+    if CLICK_SCANNER_MODE != "off":
+        reason = scanner_detector.check(params.account_id, params.newsletter_id, params.impression_id, headers)
+        if reason and CLICK_SCANNER_MODE == "drop":
+            return
+        if reason:
+            headers = {**headers, SCANNER_HEADER: reason}
+
+    click = {
+        "click_id": uuid4(),
+        "account_id": _uuid_or_none(params.account_id),
+        "newsletter_id": _uuid_or_none(params.newsletter_id),
+        "article_id": _uuid_or_none(params.article_id),
+        "impression_id": _uuid_or_none(params.impression_id),
+        "headers": allowed_headers(headers),
+        "created_at": datetime.now(timezone.utc),
+    }
+    _replay_task.ensure_started()
+    if not click_buffer.add(click):
+        # the buffer is backed up (usually because the database is), defer straight to disk
+        spool_clicks([click])
+
+
+def replay_spooled_clicks() -> int:
+    """Bulk-load spooled clicks into the database. Returns how many were replayed.
+
+    Safe to run repeatedly and from several processes at once; clicks already
+    stored are skipped by their click_id. A click that fails to store goes
+    back to the spool, and to the `.dead` spool after CLICK_MAX_REPLAY_ATTEMPTS
+    tries, so it can't block the clicks behind it.
+    """
+    if not click_spool.has_pending():
+        return 0
+
+    with _replay_lock:
+        try:
+            with DB_ENGINE.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        except Exception:
+            logger.warning("database unavailable, leaving spooled clicks for later")
+            return 0
+
+        replayed = 0
+        for claimed in click_spool.claim():
+            records = click_spool.read(claimed)
+            failed = []
+            for start in range(0, len(records), CLICK_REPLAY_BATCH_SIZE):
+                batch = records[start : start + CLICK_REPLAY_BATCH_SIZE]
+                try:
+                    store_clicks([_decode_click(record) for record in batch])
+                except Exception:
+                    logger.warning("spooled click batch failed, trying its clicks one at a time", exc_info=True)
+                    failed.extend(_replay_one_by_one(batch))
+            _requeue_clicks(failed)
+            click_spool.release(claimed)
+            replayed += len(records) - len(failed)
+            logger.info(f"replayed {len(records) - len(failed)} of {len(records)} spooled clicks from {claimed}")
+        return replayed
+
+
+def _replay_one_by_one(records):
+    # so one bad click (bad data, a missing foreign key) doesn't hold back the rest of its batch
+    failed = []
+    for record in records:
+        try:
+            store_clicks([_decode_click(record)])
+        except Exception:
+            failed.append(record)
+    return failed
+
+
+def _requeue_clicks(records):
+    retry = []
+    dead = []
+    for record in records:
+        record = {**record, "attempts": record.get("attempts", 0) + 1}
+        (retry if record["attempts"] < CLICK_MAX_REPLAY_ATTEMPTS else dead).append(record)
+    if retry:
+        click_spool.append(retry)
+    if dead:
+        logger.error(f"CLICK TRACKING FAILURE: giving up on {len(dead)} clicks, kept in {dead_click_spool.path}")
+        dead_click_spool.append(dead)
+
+
+_replay_task = PeriodicTask("click-spool-replay", replay_spooled_clicks, CLICK_REPLAY_INTERVAL)
@@ -0,0 +1,190 @@
+import json
+import logging
+import threading
+import time
+from os import environ as env
+from uuid import uuid4
+
+from util.spool import Spool
+from util.write_buffer import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# the outbox and its .dead file hold rendered emails in plain text, sign-in token links included, so keep
+# them on a volume only the app can read. It must also outlive the container, or queued emails die with it.
+EMAIL_OUTBOX_PATH = env.get("EMAIL_OUTBOX_PATH", "spool/email_outbox.jsonl")
+EMAIL_QUEUE_BACKEND = env.get("EMAIL_QUEUE_BACKEND", "sqs")  # "sqs" or "memory"
+EMAIL_DISPATCH_INTERVAL = float(env.get("EMAIL_DISPATCH_INTERVAL", 1.0))
+EMAIL_MAX_ATTEMPTS = int(env.get("EMAIL_MAX_ATTEMPTS", 10))
+# a failed message waits this long before its next try, doubling each time up to EMAIL_MAX_BACKOFF,
+# so ten tries ride out about a quarter of an hour of SQS trouble
+EMAIL_BACKOFF = float(env.get("EMAIL_BACKOFF", 2.0))
+EMAIL_MAX_BACKOFF = float(env.get("EMAIL_MAX_BACKOFF", 5 * 60))
+# long enough to look into a failure; the token links in them have expired well before this
+EMAIL_DEAD_RETENTION_DAYS = float(env.get("EMAIL_DEAD_RETENTION_DAYS", 14))
+EMAIL_DEAD_PRUNE_INTERVAL = 60 * 60
+SQS_BATCH_SIZE = 10  # the most SendMessageBatch accepts
+
+
+class SqsEmailQueue:
+    def __init__(self) -> None:
+        self._client = None
+
+    def send_message_batch(self, queue_url, entries) -> dict:
+        if self._client is None:
+            # the same default credential chain and region poprox-storage's own SQS calls use
+            import boto3
+
+            self._client = boto3.client("sqs")
+        return self._client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+
+
+class InMemoryEmailQueue:
+    """Stand-in for SQS, so the signup flow can run end to end without AWS."""
+
+    def __init__(self) -> None:
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def send_message_batch(self, queue_url, entries) -> dict:
+        with self._lock:
+            self.messages.extend((queue_url, entry["MessageBody"]) for entry in entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in entries], "Failed": []}
+
+
+class EmailOutbox:
+    """Durable outbox between the request that renders an email and the queue that sends it.
+
+    `put` only appends the message to a local spool. A background dispatcher
+    drains the spool in SendMessageBatch-sized batches, puts failed messages
+    back for another attempt after an exponential backoff, and gives up on a
+    message after `max_attempts`.
+    Given-up messages are kept in a `.dead` spool for EMAIL_DEAD_RETENTION_DAYS.
+    """
+
+    def __init__(self, spool: Spool, queue, max_attempts=EMAIL_MAX_ATTEMPTS) -> None:
+        self.spool = spool
+        self.queue = queue
+        self._max_attempts = max_attempts
+        self._dead = Spool(str(spool.path) + ".dead")
+        self._pruned_at = 0.0
+        self._dispatch_lock = threading.Lock()
+        self._task = PeriodicTask("email-outbox", self.dispatch, EMAIL_DISPATCH_INTERVAL)
+        self._counts = {"queued": 0, "sent": 0, "retried": 0, "dead": 0}
+
+    def put(self, queue_url, email_to, subject, html) -> None:
+        message = {
+            "message_id": str(uuid4()),
+            "queue_url": queue_url,
+            "attempts": 0,
+            "body": json.dumps({"email_to": email_to, "email_subject": subject, "email_body": html}),
+        }
+        self.spool.append([message])
+        self._counts["queued"] += 1
+        self.start()
+
+    def start(self) -> None:
+        """Start the dispatcher, e.g. to drain messages left over from before a restart."""
+        self._task.ensure_started()
+
+    def dispatch(self) -> int:
+        """Send everything in the outbox. Returns how many messages were accepted by the queue."""
+        if time.monotonic() - self._pruned_at > EMAIL_DEAD_PRUNE_INTERVAL:
+            self.prune_dead()
+        if not self.spool.has_pending():
+            return 0
+        with self._dispatch_lock:
+            sent = 0
+            now = time.time()
+            for claimed in self.spool.claim():
+                retry = []
+                messages = []
+                waiting = []
+                for message in self.spool.read(claimed):
+                    (messages if message.get("next_attempt_at", 0) <= now else waiting).append(message)
+                self.spool.append(waiting)
+                for start in range(0, len(messages), SQS_BATCH_SIZE):
+                    batch = messages[start : start + SQS_BATCH_SIZE]
+                    accepted, failed = self._send_batch(batch)
+                    sent += accepted
+                    retry.extend(failed)
+                self._requeue(retry)
+                self.spool.release(claimed)
+            self._counts["sent"] += sent
+            return sent
+
+    def prune_dead(self) -> int:
+        """Delete given-up messages older than EMAIL_DEAD_RETENTION_DAYS. Returns how many were deleted."""
+        self._pruned_at = time.monotonic()
+        if not self._dead.has_pending():
+            return 0
+        cutoff = time.time() - EMAIL_DEAD_RETENTION_DAYS * 24 * 60 * 60
+        pruned = 0
+        with self._dispatch_lock:
+            for claimed in self._dead.claim():
+                messages = self._dead.read(claimed)
+                # messages from before dead_at was recorded count as just given up
+                kept = [message for message in messages if message.setdefault("dead_at", time.time()) > cutoff]
+                self._dead.append(kept)
+                self._dead.release(claimed)
+                pruned += len(messages) - len(kept)
+        if pruned:
+            logger.info(f"deleted {pruned} emails given up on more than {EMAIL_DEAD_RETENTION_DAYS:g} days ago")
+        return pruned
+
+    def stats(self) -> dict:
+        return dict(self._counts)
+
+    def _send_batch(self, batch):
+        by_queue = {}
+        for message in batch:
+            by_queue.setdefault(message["queue_url"], []).append(message)
+
+        accepted = 0
+        failed = []
+        for queue_url, messages in by_queue.items():
+            entries = [{"Id": str(i), "MessageBody": message["body"]} for i, message in enumerate(messages)]
+            try:
+                response = self.queue.send_message_batch(queue_url, entries)
+            except Exception:
+                logger.exception("couldn't send %d emails, will retry", len(messages))
+                failed.extend(messages)
+                continue
+            failed_ids = {entry["Id"] for entry in response.get("Failed", [])}
+            for i, message in enumerate(messages):
+                if str(i) in failed_ids:
+                    failed.append(message)
+                else:
+                    accepted += 1
+        return accepted, failed
+
+    def _requeue(self, messages):
+        retry = []
+        dead = []
+        now = time.time()
+        for message in messages:
+            attempts = message["attempts"] + 1
+            backoff = min(EMAIL_BACKOFF * 2 ** (attempts - 1), EMAIL_MAX_BACKOFF)
+            message = {**message, "attempts": attempts, "next_attempt_at": now + backoff}
+            if attempts < self._max_attempts:
+                retry.append(message)
+            else:
+                dead.append({**message, "dead_at": time.time()})
+        if retry:
+            self.spool.append(retry)
+            self._counts["retried"] += len(retry)
+        if dead:
+            logger.error(f"EMAIL SEND FAILURE: giving up on {len(dead)} emails, kept in {self._dead.path}")
+            self._dead.append(dead)
+            self._counts["dead"] += len(dead)
+
+
+def _make_queue(backend):
+    if backend == "memory":
+        return InMemoryEmailQueue()
+    if backend != "sqs":
+        raise RuntimeError(f"unknown EMAIL_QUEUE_BACKEND {backend!r}")
+    return SqsEmailQueue()
+
+
+email_outbox = EmailOutbox(Spool(EMAIL_OUTBOX_PATH), _make_queue(EMAIL_QUEUE_BACKEND))
@@ -0,0 +1,36 @@
+from functools import lru_cache
+from os import environ as env
+from pathlib import Path
+
+import jinja2
+from flask import url_for
+
+EMAIL_TEMPLATE_DIR = Path(__file__).resolve().parent.parent / "email_templates"
+# unset means jinja's own per-user cache directory, which it creates readable by this user only
+EMAIL_TEMPLATE_CACHE_DIR = env.get("EMAIL_TEMPLATE_CACHE_DIR")
+CONSENT_FORM_FILENAME = "Subscriber_Agreement_v2.pdf"
+
+# one environment per process; templates are compiled once (the bytecode cache also saves workers the parse)
+EMAIL_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(EMAIL_TEMPLATE_DIR),
+    autoescape=jinja2.select_autoescape(),
+    bytecode_cache=jinja2.FileSystemBytecodeCache(EMAIL_TEMPLATE_CACHE_DIR),
+    auto_reload=False,
+)
+ENROLL_TOKEN_TEMPLATE = EMAIL_ENV.get_template("enroll_token_email.html")
+POST_CONSENT_TEMPLATE = EMAIL_ENV.get_template("enroll_post_consent.html")
+
+
+def render_enroll_token_email(enroll_link, token) -> str:
+    return ENROLL_TOKEN_TEMPLATE.render(enroll_link=enroll_link, token=token)
+
+
+def render_post_consent_email() -> str:
+    # must run in a request context -- the consent form link is absolute, so it depends on the host
+    return _render_post_consent_email(url_for("static", filename=CONSENT_FORM_FILENAME, _external=True))
+
+
+@lru_cache(maxsize=8)
+def _render_post_consent_email(consent_form_link) -> str:
+    # nothing in this email is specific to the subscriber, so each host's copy is rendered once
+    return POST_CONSENT_TEMPLATE.render(consent_form_link=consent_form_link)
@@ -0,0 +1,146 @@
+import threading
+
+from poprox_storage.repositories.clicks import DbClicksRepository
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from poprox_concepts.domain import Account
+from util.entity_index import ENTITY_PAGE_TYPES
+from util.tables import storage_table, web_table
+
+# accounts this worker has seen seeded, to skip asking again
+_seeded = set()
+_seeded_lock = threading.Lock()
+
+
+def count_clicked_articles(conn, clicks) -> None:
+    """Add the entities mentioned in newly clicked articles to each account's affinity.
+
+    `clicks` are dicts with account_id and article_id. An article counts
+    once per account however often it is clicked, so this is safe to call
+    with clicks that were already counted.
+    """
+    pairs = {(click["account_id"], click["article_id"]) for click in clicks}
+    pairs = [{"account_id": account_id, "article_id": article_id} for account_id, article_id in pairs if article_id]
+    if not pairs:
+        return
+
+    seen_table = web_table("web_entity_affinity_articles")
+    new_pairs = conn.execute(
+        insert(seen_table)
+        .values(pairs)
+        .on_conflict_do_nothing()
+        .returning(seen_table.c.account_id, seen_table.c.article_id)
+    ).all()
+    if not new_pairs:
+        return
+
+    accounts_by_article = {}
+    for account_id, article_id in new_pairs:
+        accounts_by_article.setdefault(article_id, []).append(account_id)
+
+    mentions_table = storage_table(conn, "mentions")
+    entities_table = storage_table(conn, "entities")
+    mentions = conn.execute(
+        select(
+            mentions_table.c.article_id,
+            entities_table.c.entity_id,
+            entities_table.c.name,
+            entities_table.c.entity_type,
+        )
+        .join(entities_table, entities_table.c.entity_id == mentions_table.c.entity_id)
+        .where(mentions_table.c.article_id.in_(accounts_by_article))
+        .where(entities_table.c.entity_type.in_(ENTITY_PAGE_TYPES))
+    )
+
+    counts = {}
+    for mention in mentions:
+        for account_id in accounts_by_article[mention.article_id]:
+            key = (account_id, mention.entity_id)
+            row = counts.setdefault(
+                key,
+                {
+                    "account_id": account_id,
+                    "entity_id": mention.entity_id,
+                    "entity_name": mention.name,
+                    "entity_type": mention.entity_type,
+                    "mentions": 0,
+                },
+            )
+            row["mentions"] += 1
+    if not counts:
+        return
+
+    affinity_table = web_table("web_entity_affinity")
+    stmt = insert(affinity_table).values(list(counts.values()))
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[affinity_table.c.account_id, affinity_table.c.entity_id],
+            set_={"mentions": affinity_table.c.mentions + stmt.excluded.mentions},
+        )
+    )
+    bump_account_versions(conn, {account_id for account_id, _ in counts})
+
+
+def bump_account_versions(conn, account_ids) -> None:
+    """Mark the accounts' suggestions as changed, so browsers holding the old ones fetch them again."""
+    versions_table = web_table("web_account_versions")
+    stmt = insert(versions_table).values([{"account_id": account_id, "version": 1} for account_id in account_ids])
+    conn.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[versions_table.c.account_id],
+            set_={"version": versions_table.c.version + 1},
+        )
+    )
+
+
+def fetch_account_version(conn, account_id) -> int:
+    versions_table = web_table("web_account_versions")
+    version = conn.execute(
+        select(versions_table.c.version).where(versions_table.c.account_id == account_id)
+    ).scalar_one_or_none()
+    return version or 0
+
+
+def ensure_seeded(conn, account_id) -> None:
+    """Count the clicks an account made before affinities were kept, the first time its affinity is asked for."""
+    with _seeded_lock:
+        if account_id in _seeded:
+            return
+    accounts_table = web_table("web_entity_affinity_accounts")
+    seeded = conn.execute(select(accounts_table.c.account_id).where(accounts_table.c.account_id == account_id)).first()
+    if seeded is not None:
+        with _seeded_lock:
+            _seeded.add(account_id)
+        return
+    started = conn.execute(
+        insert(accounts_table)
+        .values(account_id=account_id)
+        .on_conflict_do_nothing()
+        .returning(accounts_table.c.account_id)
+    ).first()
+    if started is None:
+        return  # another request got there first
+
+    click_repo = DbClicksRepository(conn)
+    account = Account(account_id=account_id, status="active")
+    clicks = click_repo.fetch_clicks([account]).get(account_id, [])
+    count_clicked_articles(conn, [{"account_id": account_id, "article_id": click.article_id} for click in clicks])
+
+
+def top_entities(conn, account_id, limit, exclude_names=()) -> list[dict]:
+    """The account's most-mentioned entities across everything it has clicked, best first."""
+    exclude_names = {name.lower() for name in exclude_names}
+    affinity_table = web_table("web_entity_affinity")
+    rows = conn.execute(
+        select(affinity_table.c.entity_name, affinity_table.c.entity_type)
+        .where(affinity_table.c.account_id == account_id)
+        .order_by(affinity_table.c.mentions.desc(), affinity_table.c.entity_name)
+        .limit(limit + len(exclude_names))
+    )
+    entities = [
+        {"name": row.entity_name, "entity_type": row.entity_type}
+        for row in rows
+        if row.entity_name.lower() not in exclude_names
+    ]
+    return entities[:limit]
@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from os import environ as env
+
+from sqlalchemy import func, select
+
+from util.entity_search import MAX_RESULTS, EntitySnapshot, fold
+from util.etags import make_etag
+from util.postgres_db import db_connection
+from util.tables import storage_table
+from util.write_buffer import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# Entity types handled by the People, Organizations & Places page (topics/subjects
+# are managed on the separate Customize Newsletter page and are excluded here).
+ENTITY_PAGE_TYPES = {"person", "organization", "place"}
+
+ENTITY_INDEX_REFRESH_INTERVAL = float(env.get("ENTITY_INDEX_REFRESH_INTERVAL", 5 * 60))
+ENTITY_INDEX_REBUILD_INTERVAL = float(env.get("ENTITY_INDEX_REBUILD_INTERVAL", 60 * 60))
+STARTER_ENTITIES_REFRESH_INTERVAL = float(env.get("STARTER_ENTITIES_REFRESH_INTERVAL", 60 * 60))
+STARTER_ENTITIES_WINDOW_DAYS = int(env.get("STARTER_ENTITIES_WINDOW_DAYS", 7))
+STARTER_ENTITIES_SIZE = 100  # enough to still have some left after leaving out what a user already rated
+
+
+class EntityIndex:
+    """In-process autocomplete over entity names, ranked by how often the entity is mentioned.
+
+    Built once per worker, then topped up every `refresh_interval` seconds
+    with entities created since the last load and rebuilt from scratch
+    every `rebuild_interval` seconds so popularity stays current.
+    """
+
+    def __init__(
+        self,
+        entity_types,
+        refresh_interval=ENTITY_INDEX_REFRESH_INTERVAL,
+        rebuild_interval=ENTITY_INDEX_REBUILD_INTERVAL,
+    ) -> None:
+        self._entity_types = sorted(entity_types)
+        self._rebuild_interval = rebuild_interval
+        self._snapshot = None
+        self._loaded_through = None  # newest created_at seen, for incremental refreshes
+        self._rebuilt_at = 0.0
+        self._load_lock = threading.Lock()
+        self._task = PeriodicTask("entity-index", self.refresh, refresh_interval)
+
+    def search(self, query, limit=10) -> list[dict]:
+        query = fold(query)
+        if not query:
+            return []
+        snapshot = self._snapshot or self._warmed()
+        return [
+            {"name": snapshot.entities[entity_id][0], "entity_type": snapshot.entities[entity_id][1]}
+            for entity_id in snapshot.search(query, min(limit, MAX_RESULTS))
+        ]
+
+    def version(self) -> str:
+        """Changes whenever the index does, so search results can be revalidated instead of resent."""
+        return (self._snapshot or self._warmed()).version
+
+    def warm(self) -> None:
+        """Build the index now, e.g. when a worker starts, instead of on the first search."""
+        self._warmed()
+
+    def refresh(self) -> None:
+        full = self._snapshot is None or time.monotonic() - self._rebuilt_at > self._rebuild_interval
+        with self._load_lock:
+            self._load(full)
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        return {
+            "entities": len(snapshot.entities) if snapshot else 0,
+            "keys": len(snapshot.keys) if snapshot else 0,
+            "rebuilt_seconds_ago": time.monotonic() - self._rebuilt_at if snapshot else None,
+        }
+
+    def _warmed(self):
+        with self._load_lock:
+            if self._snapshot is None:
+                self._load(full=True)
+        self._task.ensure_started()
+        return self._snapshot
+
+    def _load(self, full):
+        incremental = not full and self._loaded_through is not None
+        with db_connection(read_only=True) as conn:
+            entities_table = storage_table(conn, "entities")
+            mentions_table = storage_table(conn, "mentions")
+            if "created_at" not in entities_table.c:
+                raise RuntimeError("entities table has no created_at column, so the entity index can't be refreshed")
+
+            wanted = entities_table.c.entity_type.in_(self._entity_types)
+            if incremental:
+                wanted &= entities_table.c.created_at > self._loaded_through
+            mention_counts = select(mentions_table.c.entity_id, func.count().label("mentions"))
+            if incremental:
+                # only count mentions of the new entities, not of everything
+                mention_counts = mention_counts.where(
+                    mentions_table.c.entity_id.in_(select(entities_table.c.entity_id).where(wanted))
+                )
+            mention_counts = mention_counts.group_by(mentions_table.c.entity_id).subquery()
+            stmt = (
+                select(
+                    entities_table.c.entity_id,
+                    entities_table.c.name,
+                    entities_table.c.entity_type,
+                    entities_table.c.created_at,
+                    func.coalesce(mention_counts.c.mentions, 0).label("mentions"),
+                )
+                .select_from(
+                    entities_table.outerjoin(mention_counts, mention_counts.c.entity_id == entities_table.c.entity_id)
+                )
+                .where(wanted)
+            )
+            rows = conn.execute(stmt).all()
+
+        if incremental and not rows:
+            return
+        loaded = {}
+        loaded_through = self._loaded_through if incremental else None
+        for row in rows:
+            loaded[row.entity_id] = (row.name, row.entity_type, row.mentions)
+            if row.created_at is not None and (loaded_through is None or row.created_at > loaded_through):
+                loaded_through = row.created_at
+
+        # built aside and swapped in whole, so searches never see a half-built index
+        if incremental:
+            entities = {**self._snapshot.entities, **loaded}
+            self._snapshot = EntitySnapshot(entities, base=self._snapshot, added=loaded)
+        else:
+            self._snapshot = EntitySnapshot(loaded)
+            self._rebuilt_at = time.monotonic()
+        self._loaded_through = loaded_through
+        logger.info(
+            f"entity index {'updated' if incremental else 'built'}: {len(loaded)} of {len(self._snapshot.entities)} "
+            "entities loaded"
+        )
+
+
+class StarterEntities:
+    """The entities mentioned most in recent articles, suggested to users with no click history of their own.
+
+    Recomputed every `refresh_interval` seconds on a background thread.
+    """
+
+    def __init__(
+        self,
+        entity_types,
+        window_days=STARTER_ENTITIES_WINDOW_DAYS,
+        refresh_interval=STARTER_ENTITIES_REFRESH_INTERVAL,
+    ) -> None:
+        self._entity_types = sorted(entity_types)
+        self._window = timedelta(days=window_days)
+        self._entities = None
+        self._version = None
+        self._load_lock = threading.Lock()
+        self._task = PeriodicTask("starter-entities", self.refresh, refresh_interval)
+
+    def get(self, limit, exclude_names=()) -> list[dict]:
+        exclude_names = {name.lower() for name in exclude_names}
+        entities = self._entities if self._entities is not None else self._warmed()
+        return [entity for entity in entities if entity["name"].lower() not in exclude_names][:limit]
+
+    def version(self) -> str:
+        if self._entities is None:
+            self._warmed()
+        return self._version
+
+    def warm(self) -> None:
+        self._warmed()
+
+    def refresh(self) -> None:
+        with db_connection(read_only=True) as conn:
+            entities_table = storage_table(conn, "entities")
+            mentions_table = storage_table(conn, "mentions")
+            articles_table = storage_table(conn, "articles")
+            mentions = func.count(mentions_table.c.entity_id)
+            stmt = (
+                select(entities_table.c.name, entities_table.c.entity_type, mentions)
+                .select_from(
+                    mentions_table.join(entities_table, entities_table.c.entity_id == mentions_table.c.entity_id).join(
+                        articles_table, articles_table.c.article_id == mentions_table.c.article_id
+                    )
+                )
+                .where(entities_table.c.entity_type.in_(self._entity_types))
+                .group_by(entities_table.c.entity_id, entities_table.c.name, entities_table.c.entity_type)
+                .order_by(mentions.desc(), entities_table.c.name)
+                .limit(STARTER_ENTITIES_SIZE)
+            )
+            since = datetime.now(timezone.utc) - self._window
+            rows = conn.execute(stmt.where(articles_table.c.published_at >= since)).all()
+            if not rows:
+                # nothing ingested lately (e.g. a fresh dev database), so go by all time instead
+                rows = conn.execute(stmt).all()
+        entities = [{"name": row.name, "entity_type": row.entity_type} for row in rows]
+        self._version = make_etag(*((entity["name"], entity["entity_type"]) for entity in entities))
+        self._entities = entities
+
+    def _warmed(self):
+        with self._load_lock:
+            if self._entities is None:
+                self.refresh()
+        self._task.ensure_started()
+        return self._entities
+
+
+entity_index = EntityIndex(ENTITY_PAGE_TYPES)
+starter_entities = StarterEntities(ENTITY_PAGE_TYPES)
@@ -0,0 +1,83 @@
+import heapq
+from bisect import bisect_left
+
+from util.etags import make_etag
+
+MAX_RESULTS = 20
+# answers for prefixes this short are worked out when the index is built, since they match too much to rank per query
+PRECOMPUTED_PREFIX_LENGTH = 3
+
+
+def fold(text) -> str:
+    return " ".join(text.casefold().split())
+
+
+class EntitySnapshot:
+    """An immutable build of the entity name index (`util.entity_index.EntityIndex`), which searches the current one.
+
+    Built in full from `entities`, or from a `base` snapshot plus the entities
+    `added` since, in which case only the added entities are worked through:
+    they go in a small sorted list of their own next to the base's, and are
+    folded into the main one at the next full build.
+    """
+
+    def __init__(self, entities: dict, base=None, added=None) -> None:
+        self.entities = entities  # entity_id -> (name, entity_type, popularity)
+        new = entities if base is None else added
+        pairs = sorted(_word_starts(new))
+
+        if base is None:
+            self.keys = [key for key, _ in pairs]
+            self.ids = [entity_id for _, entity_id in pairs]
+            self.added_keys, self.added_ids = [], []
+            self.top = {}
+            self._digest = 0
+        else:
+            self.keys, self.ids = base.keys, base.ids
+            added_pairs = list(heapq.merge(zip(base.added_keys, base.added_ids), pairs))
+            self.added_keys = [key for key, _ in added_pairs]
+            self.added_ids = [entity_id for _, entity_id in added_pairs]
+            self.top = dict(base.top)
+            self._digest = base._digest
+
+        buckets = {}
+        for key, entity_id in pairs:
+            for length in range(1, min(len(key), PRECOMPUTED_PREFIX_LENGTH) + 1):
+                buckets.setdefault(key[:length], set()).add(entity_id)
+        for prefix, ids in buckets.items():
+            # an incremental build leaves popularity alone, so the best of the old top and the new entities is the top
+            self.top[prefix] = self.best(ids.union(self.top.get(prefix, ())), MAX_RESULTS)
+
+        for entity_id, entity in new.items():
+            self._digest ^= int(make_etag(entity_id, entity), 16)
+        # an xor of per-entity hashes: the same for every worker holding the same entities, so ETags hold
+        # across workers, and extended without hashing everything again
+        self.version = f"{self._digest:032x}"
+
+    def best(self, entity_ids, limit) -> list:
+        def sort_key(entity_id):
+            name, _, popularity = self.entities[entity_id]
+            return (-popularity, len(name), name)
+
+        return heapq.nsmallest(limit, entity_ids, key=sort_key)
+
+    def search(self, query, limit):
+        if len(query) <= PRECOMPUTED_PREFIX_LENGTH:
+            return self.top.get(query, [])[:limit]
+        matches = set(_prefix_range(self.keys, self.ids, query))
+        matches.update(_prefix_range(self.added_keys, self.added_ids, query))
+        return self.best(matches, limit)
+
+
+def _word_starts(entities):
+    # each entity is findable from the start of any of its words: "barack obama", "obama"
+    for entity_id, (name, _, _) in entities.items():
+        words = fold(name).split(" ")
+        for i in range(len(words)):
+            yield (" ".join(words[i:]), entity_id)
+
+
+def _prefix_range(keys, ids, prefix):
+    lo = bisect_left(keys, prefix)
+    hi = bisect_left(keys, prefix + "\U0010ffff", lo)
+    return ids[lo:hi]
@@ -0,0 +1,27 @@
+import hashlib
+
+from flask import Response, request
+
+
+def make_etag(*parts) -> str:
+    """A strong validator for a response that is fully determined by `parts`."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def not_modified(etag) -> Response | None:
+    """A 304 if the browser already has this version of the response, else None and the view carries on."""
+    # If-None-Match uses weak comparison, and proxies that compress the response may hand back a W/ tag
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_etag(Response(status=304), etag)
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    # per-user data: the browser may keep it, but has to check back each time
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
@@ -0,0 +1,170 @@
+import atexit
+import logging
+import threading
+import time
+from enum import Enum
+from os import environ as env
+from uuid import UUID
+
+from util.spool import Spool
+from util.write_buffer import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+NEWSLETTER_REQUEST_PATH = env.get("NEWSLETTER_REQUEST_PATH", "spool/newsletter_requests.jsonl")
+NEWSLETTER_REQUEST_WINDOW = float(env.get("NEWSLETTER_REQUEST_WINDOW", 30.0))
+# however often an account keeps asking, its request goes out after this long
+NEWSLETTER_REQUEST_MAX_DELAY = float(env.get("NEWSLETTER_REQUEST_MAX_DELAY", 5 * 60))
+NEWSLETTER_REQUEST_ATTEMPTS = int(env.get("NEWSLETTER_REQUEST_ATTEMPTS", 8))
+# a failed send waits this long before its next try, doubling each time up to NEWSLETTER_REQUEST_MAX_BACKOFF,
+# so eight tries ride out about ten minutes of queue trouble
+NEWSLETTER_REQUEST_BACKOFF = float(env.get("NEWSLETTER_REQUEST_BACKOFF", 5.0))
+NEWSLETTER_REQUEST_MAX_BACKOFF = float(env.get("NEWSLETTER_REQUEST_MAX_BACKOFF", 5 * 60))
+UUID_ARGUMENTS = ("account_id", "profile_id", "group_id")
+
+
+class NewsletterRequestDispatcher:
+    """Collapses newsletter requests for the same account and sends them off the request thread.
+
+    Requests are written to a spool shared by every worker, so they survive a
+    restart and are merged even when the calls land on different workers. An
+    account's request is sent once `window` seconds pass without another one
+    for it; each new request merges into the pending one (later arguments win,
+    arguments the later call left out are kept) and restarts the wait, so
+    onboarding produces one recommender run instead of two. The wait never
+    runs past `max_delay` from the account's first pending request.
+
+    A request that fails to send is retried with exponential backoff, and
+    moved to a `.dead` spool after NEWSLETTER_REQUEST_ATTEMPTS tries.
+    """
+
+    def __init__(
+        self,
+        send_fn,
+        spool: Spool,
+        window=NEWSLETTER_REQUEST_WINDOW,
+        max_delay=NEWSLETTER_REQUEST_MAX_DELAY,
+        decode_fn=None,
+    ) -> None:
+        self._send_fn = send_fn
+        self._decode_fn = decode_fn or (lambda kwargs: kwargs)
+        self.spool = spool
+        self._dead = Spool(str(spool.path) + ".dead")
+        self._window = window
+        self._max_delay = max_delay
+        self._dispatch_lock = threading.Lock()
+        self._task = PeriodicTask("newsletter-requests", self.dispatch, min(1.0, window))
+        self._held = 0
+        self._counts = {"requested": 0, "collapsed": 0, "sent": 0, "retried": 0, "dead": 0}
+
+    def request(self, account_id, **kwargs) -> None:
+        now = time.time()
+        kwargs = {"account_id": account_id, **kwargs}
+        self.spool.append([{"kwargs": _encode(kwargs), "first_requested_at": now, "requested_at": now, "attempts": 0}])
+        self._counts["requested"] += 1
+        self.start()
+
+    def start(self) -> None:
+        """Start the dispatcher, e.g. to send requests left over from before a restart."""
+        self._task.ensure_started()
+
+    def dispatch(self, force=False) -> int:
+        """Send every request whose window has closed and isn't backing off (or all of them, with `force`)."""
+        if not self.spool.has_pending():
+            return 0
+        with self._dispatch_lock:
+            claimed = self.spool.claim()
+            records = [record for path in claimed for record in self.spool.read(path)]
+            pending = self._merge(records)
+
+            now = time.time()
+            held = []
+            dead = []
+            sent = 0
+            for record in pending:
+                due = min(record["requested_at"] + self._window, record["first_requested_at"] + self._max_delay)
+                due = max(due, record.get("next_attempt_at", 0))
+                if not force and due > now:
+                    held.append(record)
+                    continue
+                try:
+                    self._send_fn(**self._decode_fn(record["kwargs"]))
+                    sent += 1
+                except Exception:
+                    logger.exception("couldn't enqueue newsletter for %s", record["kwargs"]["account_id"])
+                    attempts = record["attempts"] + 1
+                    backoff = min(NEWSLETTER_REQUEST_BACKOFF * 2 ** (attempts - 1), NEWSLETTER_REQUEST_MAX_BACKOFF)
+                    record = {**record, "attempts": attempts, "next_attempt_at": now + backoff}
+                    if attempts < NEWSLETTER_REQUEST_ATTEMPTS:
+                        held.append(record)
+                        self._counts["retried"] += 1
+                    else:
+                        dead.append(record)
+
+            # written back before the claimed files go, so a crash in between sends twice rather than never
+            self.spool.append(held)
+            if dead:
+                logger.error(f"NEWSLETTER REQUEST FAILURE: gave up on {len(dead)} requests, kept in {self._dead.path}")
+                self._dead.append(dead)
+            for path in claimed:
+                self.spool.release(path)
+            self._held = len(held)
+            self._counts["sent"] += sent
+            self._counts["dead"] += len(dead)
+            return sent
+
+    def close(self) -> None:
+        # no last send: pending requests are on disk, and sending them now would skip their merge window.
+        # Whichever worker runs next sends them.
+        self._task.stop()
+
+    def stats(self) -> dict:
+        return {"pending": self._held, **self._counts}
+
+    def _merge(self, records):
+        merged = {}
+        for record in sorted(records, key=lambda record: record["requested_at"]):
+            account_id = record["kwargs"]["account_id"]
+            pending = merged.get(account_id)
+            if pending is None:
+                merged[account_id] = dict(record)
+                continue
+            pending["kwargs"] = {**pending["kwargs"], **record["kwargs"]}
+            pending["first_requested_at"] = min(pending["first_requested_at"], record["first_requested_at"])
+            pending["requested_at"] = record["requested_at"]
+            pending["attempts"] = max(pending["attempts"], record["attempts"])
+            pending["next_attempt_at"] = max(pending.get("next_attempt_at", 0), record.get("next_attempt_at", 0))
+            self._counts["collapsed"] += 1
+        return list(merged.values())
+
+
+def _encode(kwargs) -> dict:
+    return {
+        name: value.value if isinstance(value, Enum) else str(value) if isinstance(value, UUID) else value
+        for name, value in kwargs.items()
+    }
+
+
+def _enqueue_newsletter_request(**kwargs):
+    # imported on first send, like boto3 in util.email_outbox, so the dispatcher loads without poprox-storage
+    from poprox_storage.aws.queues import enqueue_newsletter_request
+
+    return enqueue_newsletter_request(**kwargs)
+
+
+def _decode_enqueue_kwargs(kwargs) -> dict:
+    from poprox_concepts.api.recommendations.versions import ProtocolVersions
+
+    kwargs = dict(kwargs)
+    for name in UUID_ARGUMENTS:
+        if kwargs.get(name) is not None:
+            kwargs[name] = UUID(kwargs[name])
+    if kwargs.get("api_version") is not None:
+        kwargs["api_version"] = ProtocolVersions(kwargs["api_version"])
+    return kwargs
+
+
+newsletter_requests = NewsletterRequestDispatcher(
+    _enqueue_newsletter_request, Spool(NEWSLETTER_REQUEST_PATH), decode_fn=_decode_enqueue_kwargs
+)
+atexit.register(newsletter_requests.close)
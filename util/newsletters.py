@@ -0,0 +1,62 @@
+from os import environ as env
+from uuid import UUID
+
+from poprox_storage.repositories.newsletters import DbNewsletterRepository
+from sqlalchemy import select
+
+from poprox_concepts.domain import Image, Newsletter
+from util.cache import TTLCache
+from util.tables import storage_table
+
+# sent newsletters never change, so entries only expire to bound how long a worker keeps one around.
+# Per-impression feedback does change and is deliberately not part of what's cached.
+NEWSLETTER_CACHE = TTLCache(
+    "newsletters",
+    max_size=int(env.get("NEWSLETTER_CACHE_SIZE", 500)),
+    ttl=float(env.get("NEWSLETTER_CACHE_TTL", 6 * 60 * 60)),
+)
+
+
+def fetch_images_by_id(conn, image_ids) -> dict[UUID, Image]:
+    """Load a set of images in one query, keyed by image_id. Ids that don't exist are left out."""
+    image_ids = set(image_ids)
+    if not image_ids:
+        return {}
+    images_table = storage_table(conn, "images")
+    rows = conn.execute(select(images_table).where(images_table.c.image_id.in_(image_ids)))
+    return {row.image_id: Image.model_validate(dict(row._mapping)) for row in rows}
+
+
+def load_newsletter_with_images(conn, newsletter_id) -> tuple[Newsletter | None, dict[UUID, Image]]:
+    """A newsletter and the preview images of its impressions, in two queries however long it is."""
+    newsletter = DbNewsletterRepository(conn).fetch_newsletter(newsletter_id) if newsletter_id else None
+    if newsletter is None:
+        return None, {}
+    images = fetch_images_by_id(
+        conn, (impression.preview_image_id for impression in newsletter.impressions if impression.preview_image_id)
+    )
+    return newsletter, images
+
+
+def cached_newsletter_with_images(conn, newsletter_id) -> tuple[Newsletter | None, dict[UUID, Image]]:
+    """`load_newsletter_with_images`, from this worker's cache after the first view. Treat the result as read-only."""
+    cached = NEWSLETTER_CACHE.get(str(newsletter_id))
+    if cached is not None:
+        return cached
+    newsletter, images = load_newsletter_with_images(conn, newsletter_id)
+    if newsletter is not None:
+        NEWSLETTER_CACHE.set(str(newsletter_id), (newsletter, images))
+    return newsletter, images
+
+
+def fetch_impression_feedback(conn, newsletter_id) -> dict[UUID, bool | None]:
+    """The reader's current thumbs up/down on each impression of a newsletter."""
+    if not newsletter_id:
+        return {}
+    impressions_table = storage_table(conn, "impressions")
+    rows = conn.execute(
+        select(impressions_table.c.impression_id, impressions_table.c.feedback).where(
+            impressions_table.c.newsletter_id == newsletter_id
+        )
+    )
+    return {row.impression_id: row.feedback for row in rows}
@@ -0,0 +1,76 @@
+import logging
+from datetime import datetime, timezone
+from os import environ as env
+from uuid import UUID
+
+from pydantic import BaseModel
+from sqlalchemy.dialects.postgresql import insert
+
+from util.postgres_db import DB_ENGINE
+from util.tables import web_table
+from util.write_buffer import WriteBuffer
+
+logger = logging.getLogger(__name__)
+
+OPEN_BUFFER_SIZE = int(env.get("OPEN_BUFFER_SIZE", 1000))
+OPEN_BUFFER_INTERVAL = float(env.get("OPEN_BUFFER_INTERVAL", 5.0))
+
+
+class OpenTrackingData(BaseModel):
+    """Payload of the signed open-tracking pixel URL, the open counterpart of TrackingLinkData.
+
+    Newsletters are rendered by the service that sends them, not here, so
+    that service builds the pixel: an <img> whose src is
+    `{URL_PREFIX}/track_pixel/<to_hashed_base64(OpenTrackingData(...), HMAC_KEY)>`
+    on this site, signed with the same HMAC key as the click tracking links.
+    The unsigned `/track_pixel` in older newsletters is still served, but not counted.
+    """
+
+    account_id: UUID
+    newsletter_id: UUID
+
+
+def store_opens(opens: list[dict]) -> None:
+    """Fold a batch of opens into one row per (account, newsletter) and upsert them in a single statement."""
+    merged = {}
+    for opened in opens:
+        key = (opened["account_id"], opened["newsletter_id"])
+        row = merged.get(key)
+        if row is None:
+            merged[key] = {
+                "account_id": opened["account_id"],
+                "newsletter_id": opened["newsletter_id"],
+                "first_opened_at": opened["opened_at"],
+                "last_opened_at": opened["opened_at"],
+                "open_count": 1,
+            }
+        else:
+            row["first_opened_at"] = min(row["first_opened_at"], opened["opened_at"])
+            row["last_opened_at"] = max(row["last_opened_at"], opened["opened_at"])
+            row["open_count"] += 1
+
+    with DB_ENGINE.connect() as conn:
+        opens_table = web_table("web_newsletter_opens")
+        stmt = insert(opens_table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[opens_table.c.account_id, opens_table.c.newsletter_id],
+            set_={
+                "last_opened_at": stmt.excluded.last_opened_at,
+                "open_count": opens_table.c.open_count + stmt.excluded.open_count,
+            },
+        )
+        conn.execute(stmt, list(merged.values()))
+        conn.commit()
+
+
+open_buffer = WriteBuffer("opens", store_opens, max_items=OPEN_BUFFER_SIZE, flush_interval=OPEN_BUFFER_INTERVAL)
+
+
+def record_open(params: OpenTrackingData) -> None:
+    opened = {
+        "account_id": params.account_id,
+        "newsletter_id": params.newsletter_id,
+        "opened_at": datetime.now(timezone.utc),
+    }
+    if not open_buffer.add(opened):
+        logger.warning(f"open buffer is full, dropping open of newsletter {params.newsletter_id}")
@@ -1,16 +1,25 @@
+import copy
 import logging
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from functools import wraps
 
+from flask import g, has_request_context, request, session
+from poprox_storage.concepts.experiment import Team
 from poprox_storage.repositories.accounts import DbAccountRepository
 from poprox_storage.repositories.clicks import DbClicksRepository
 from poprox_storage.repositories.demographics import DbDemographicsRepository
 from poprox_storage.repositories.experiments import DbExperimentRepository
 from poprox_storage.repositories.qualtrics_survey import DbQualtricsSurveyRepository
 from poprox_storage.repositories.subscriptions import DbSubscriptionRepository
-from poprox_storage.repositories.teams import DbTeamRepository
 from poprox_storage.repositories.tokens import DbTokenRepository
-from sqlalchemy import create_engine
+from sqlalchemy import QueuePool, cast, create_engine, event, func, select, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import DBAPIError
 
 from poprox_concepts.api.click_filtering import filter_click_histories
 from poprox_concepts.api.tracking import Token
@@ -19,6 +28,10 @@ from poprox_concepts.domain.demographics import (
     RACE_OPTIONS,
     Demographics,
 )
+from util.cache import TTLCache
+from util.scanner_detection import SCANNER_HEADER
+from util.sql_instrumentation import instrument_engine
+from util.tables import storage_table
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -30,17 +43,351 @@ db_port = os.environ.get("POPROX_DB_PORT", 5432)
 db_name = os.environ.get("POPROX_DB_NAME", "poprox")
 
 DB_URL = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-DB_ENGINE = create_engine(DB_URL, echo=False)
+
+DB_POOL_SIZE = int(os.environ.get("POPROX_DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("POPROX_DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("POPROX_DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("POPROX_DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("POPROX_DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("POPROX_DB_STATEMENT_TIMEOUT_MS", 0))
+
+# optional read replica for views and helpers marked read-only; same credentials and database as the primary
+db_replica_host = os.environ.get("POPROX_DB_REPLICA_HOST")
+db_replica_port = os.environ.get("POPROX_DB_REPLICA_PORT", db_port)
+REPLICA_URL = f"postgresql://{db_user}:{db_password}@{db_replica_host}:{db_replica_port}/{db_name}"
+REPLICA_MAX_LAG = float(os.environ.get("POPROX_DB_REPLICA_MAX_LAG", 10))
+REPLICA_CHECK_INTERVAL = float(os.environ.get("POPROX_DB_REPLICA_CHECK_INTERVAL", 5))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get("POPROX_DB_REPLICA_CONNECT_TIMEOUT", 2))
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+# statements that don't change data; anything else run on the primary counts as a write for read-your-writes
+_NON_WRITES = re.compile(r"\s*(SELECT|SHOW|SAVEPOINT|RELEASE|ROLLBACK)\b", re.IGNORECASE)
+
+# how far the replica is behind, in seconds; 0 when it has replayed everything it received
+# or isn't a standby at all, NULL when that can't be told
+REPLICA_LAG_QUERY = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that also keeps track of how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._wait_lock:
+                self.checkouts += 1
+                self.total_wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+def create_db_engine(url, connect_timeout=None):
+    """The one way this app makes an engine, so every blueprint shares the same tuned pool."""
+    connect_args = {}
+    if DB_STATEMENT_TIMEOUT_MS:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    if connect_timeout:
+        connect_args["connect_timeout"] = connect_timeout
+    engine = create_engine(
+        url,
+        echo=False,
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+    instrument_engine(engine)
+    return engine
+
+
+class ReplicaRouter:
+    """Decides whether read-only work may go to the replica.
+
+    The replica is used only while its last health check, at most
+    `check_interval` seconds old, found it reachable and no more than
+    `max_lag` seconds behind. A failed connection marks it down until the
+    next check, and everything goes to the primary in the meantime.
+    """
+
+    def __init__(self, engine, max_lag=REPLICA_MAX_LAG, check_interval=REPLICA_CHECK_INTERVAL) -> None:
+        self.engine = engine
+        self._max_lag = max_lag
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._healthy = False
+        self._lag = None
+        self._counts = {"replica": 0, "fallback": 0, "failed_checks": 0}
+
+    def usable(self) -> bool:
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at > self._check_interval:
+            # one thread checks while the others go on with the previous verdict
+            if self._lock.acquire(blocking=self._checked_at is None):
+                try:
+                    self._check(now)
+                finally:
+                    self._lock.release()
+        return self._healthy
+
+    def connect(self):
+        """A replica connection, or None if the work should go to the primary instead."""
+        if self.usable():
+            try:
+                conn = self.engine.connect()
+            except DBAPIError:
+                logger.warning("read replica unavailable, falling back to the primary", exc_info=True)
+                self._healthy = False
+            else:
+                self._counts["replica"] += 1
+                return conn
+        self._counts["fallback"] += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            **self._counts,
+            "healthy": self._healthy,
+            "lag_seconds": self._lag,
+            "max_lag_seconds": self._max_lag,
+            **pool_stats(self.engine),
+        }
+
+    def _check(self, now):
+        try:
+            with self.engine.connect() as conn:
+                lag = conn.execute(REPLICA_LAG_QUERY).scalar()
+        except DBAPIError:
+            logger.warning("read replica health check failed", exc_info=True)
+            self._counts["failed_checks"] += 1
+            lag = None
+        self._lag = None if lag is None else float(lag)
+        self._healthy = self._lag is not None and self._lag <= self._max_lag
+        self._checked_at = now
+
+
+def read_only(view):
+    """Send the database work of GET requests to this view to the read replica, when there is one."""
+
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if request.method in SAFE_METHODS:
+            mark_read_only()
+        return view(*args, **kwargs)
+
+    return decorated
+
+
+def mark_read_only() -> None:
+    """Route the rest of this request's database work to the read replica, for views that only sometimes write."""
+    g.db_read_only = True
+
+
+@contextmanager
+def db_connection(read_only=None):
+    """Connection for the current unit of work.
+
+    Inside a request every helper, view and repository shares one connection,
+    checked out on first use; its transaction is committed once the view has
+    returned (see `commit_request_connection`) or rolled back on error.
+    Outside a request this is a fresh connection, committed when the block exits cleanly.
+
+    Read-only work -- `read_only=True`, or any work in a request marked with
+    `read_only` -- goes to the replica if one is configured and healthy, and
+    otherwise to the primary like everything else.
+    """
+    if not has_request_context():
+        conn = _replica_connection() if read_only else None
+        with conn or DB_ENGINE.connect() as conn:
+            yield conn
+            conn.commit()
+        return
+
+    if read_only is None:
+        read_only = g.get("db_read_only", False)
+    if read_only:
+        conn = g.get("db_replica_connection")
+        if conn is None and _replica_allowed():
+            conn = g.db_replica_connection = _replica_connection()
+        if conn is not None:
+            yield conn
+            return
+
+    conn = g.get("db_connection")
+    if conn is None:
+        conn = g.db_connection = DB_ENGINE.connect()
+    yield conn
+
+
+def _replica_connection():
+    return REPLICA_ROUTER.connect() if REPLICA_ROUTER is not None else None
+
+
+def _replica_allowed():
+    # after a write, this client reads from the primary for as long as the replica may lag behind
+    wrote_at = session.get("_db_wrote_at")
+    return REPLICA_ROUTER is not None and (wrote_at is None or time.time() - wrote_at > REPLICA_MAX_LAG)
+
+
+def commit_request_connection(response):
+    """after_request hook: commit the request's transaction before the response goes out.
+
+    Server errors are left for `close_request_connection` to roll back.
+    """
+    if response.status_code >= 500:
+        return response
+    conn = g.get("db_connection")
+    if conn is not None and conn.in_transaction():
+        conn.commit()
+        _finish_account_changes()
+    # any request that wrote, GET or not; this also covers writes committed early by `release_request_connection`
+    if REPLICA_ROUTER is not None and g.get("db_wrote"):
+        session["_db_wrote_at"] = time.time()
+    return response
+
+
+def _note_write(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and not _NON_WRITES.match(statement):
+        g.db_wrote = True
+
+
+def close_request_connection(exc=None):
+    """teardown_request hook: roll back whatever wasn't committed and return the connections to the pool."""
+    try:
+        _close_connections(commit=False)
+    finally:
+        _finish_account_changes()
+
+
+def rollback_request_connection() -> None:
+    """Throw away the request's uncommitted work, so a view that caught a database error can keep querying."""
+    conn = g.get("db_connection")
+    if conn is not None and conn.in_transaction():
+        conn.rollback()
+    _finish_account_changes()
+
+
+def release_request_connection() -> None:
+    """Commit the request's work so far and give its connections back to the pool.
+
+    For views about to do something slow that doesn't need the database, like
+    calling another service; a later `db_connection()` checks out a new one.
+    """
+    _close_connections(commit=True)
+    _finish_account_changes()
+
+
+def _close_connections(commit):
+    for key in ("db_connection", "db_replica_connection"):
+        conn = g.pop(key, None)
+        if conn is not None:
+            try:
+                if conn.in_transaction():
+                    if commit and key == "db_connection":
+                        conn.commit()
+                    else:
+                        conn.rollback()
+            finally:
+                conn.close()
+
+
+def pool_stats(engine) -> dict:
+    pool = engine.pool
+    stats = {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+    if isinstance(pool, TimedQueuePool):
+        stats["checkouts"] = pool.checkouts
+        stats["max_wait_seconds"] = pool.max_wait_seconds
+        stats["mean_wait_seconds"] = pool.total_wait_seconds / pool.checkouts if pool.checkouts else 0.0
+    return stats
+
+
+DB_ENGINE = create_db_engine(DB_URL)
+event.listen(DB_ENGINE, "before_cursor_execute", _note_write)
+REPLICA_ROUTER = (
+    ReplicaRouter(create_db_engine(REPLICA_URL, connect_timeout=REPLICA_CONNECT_TIMEOUT)) if db_replica_host else None
+)
 TOKEN_EXPIRATION = timedelta(hours=1)  # tokens for email are valid for 1 hour.
 
+# accounts that finished onboarding, by str(account_id). Onboarding accounts aren't cached because their
+# status changes from one request to the next, and the next request may land on another worker.
+ACCOUNT_CACHE = TTLCache(
+    "accounts",
+    max_size=int(os.environ.get("ACCOUNT_CACHE_SIZE", 10_000)),
+    ttl=float(os.environ.get("ACCOUNT_CACHE_TTL", 60)),
+)
+CACHEABLE_STATUSES = {"onboarding_done"}
+
+# callbacks run with an account_id whenever something cached about that account changes
+_account_change_listeners = []
+
+
+def on_account_changed(listener):
+    _account_change_listeners.append(listener)
+    return listener
+
+
+def notify_account_changed(account_id):
+    """Tell anything holding a copy of the account (status, teams, experiments) that it is out of date.
+
+    Inside a request the change isn't committed yet, so the listeners run now
+    -- for the rest of the request -- and again once its transaction has
+    ended, in case something cached the account in between. Until then
+    `get_account` doesn't cache it either.
+    """
+    if has_request_context():
+        g.setdefault("changed_accounts", {})[str(account_id)] = account_id
+    _run_account_listeners(account_id)
+
+
+def _run_account_listeners(account_id):
+    for listener in _account_change_listeners:
+        listener(account_id)
+
+
+def _changed_in_this_request(account_id):
+    return has_request_context() and str(account_id) in g.get("changed_accounts", {})
+
+
+def _finish_account_changes():
+    # the transaction that made the changes has been committed or rolled back
+    for account_id in g.pop("changed_accounts", {}).values():
+        _run_account_listeners(account_id)
+
+
+on_account_changed(lambda account_id: ACCOUNT_CACHE.pop(str(account_id)))
+
 
 def get_or_make_account(email, source, subsource):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         result = account_repo.fetch_account_by_email(email)
         if result is None:
             result = account_repo.store_new_account(email, source, subsource)
-            conn.commit()
         return {
             "account_id": result.account_id,
             "email": result.email,
@@ -51,31 +398,104 @@ def get_or_make_account(email, source, subsource):
 
 
 def get_account(account_id):
-    with DB_ENGINE.connect() as conn:
-        account_repo = DbAccountRepository(conn)
-        team_repo = DbTeamRepository(conn)
-        expt_repo = DbExperimentRepository(conn)
-        result = account_repo.fetch_accounts([account_id])
-        if len(result) != 1:
-            return None
+    cached = ACCOUNT_CACHE.get(str(account_id))
+    if cached is not None:
+        return copy.deepcopy(cached)
+
+    account = _load_account(account_id)
+    if account is not None and account["status"] in CACHEABLE_STATUSES and not _changed_in_this_request(account_id):
+        ACCOUNT_CACHE.set(str(account_id), copy.deepcopy(account))
+    return account
+
+
+def _load_account(account_id):
+    accounts = get_accounts([account_id])
+    return accounts[0] if len(accounts) == 1 else None
+
+
+def get_accounts(account_ids, include_teams=True, include_experiments=True) -> list[dict]:
+    """Load accounts with their team memberships (and those teams' experiments) in bulk.
+
+    Accounts, memberships and teams come back from one joined query; the
+    experiments, when wanted, cost one more query and only if any of the
+    accounts is on a team -- so a regular subscriber is a single round trip.
+    Without `include_teams` it's a plain query on accounts, and "teams" and
+    "experiments" are left empty.
+    """
+    account_ids = list(account_ids)
+    if not account_ids:
+        return []
+
+    with db_connection() as conn:
+        accounts_table = storage_table(conn, "accounts")
+        memberships_table = storage_table(conn, "team_memberships")
+        teams_table = storage_table(conn, "teams")
+        own_membership = memberships_table.alias("own_membership")
+        team_members = memberships_table.alias("team_members")
+
+        account_columns = (
+            accounts_table.c.account_id,
+            accounts_table.c.email,
+            accounts_table.c.status,
+            accounts_table.c.source,
+            accounts_table.c.subsource,
+        )
+        if include_teams:
+            stmt = select(
+                *account_columns,
+                teams_table.c.team_id,
+                teams_table.c.team_name,
+                team_members.c.account_id.label("member_id"),
+            ).select_from(
+                accounts_table.outerjoin(own_membership, own_membership.c.account_id == accounts_table.c.account_id)
+                .outerjoin(teams_table, teams_table.c.team_id == own_membership.c.team_id)
+                .outerjoin(team_members, team_members.c.team_id == teams_table.c.team_id)
+            )
         else:
-            result = result[0]
-            result = {
-                "account_id": result.account_id,
-                "email": result.email,
-                "status": result.status,
-                "source": result.source,
-                "subsource": result.subsource,
-            }
-            result["teams"] = team_repo.fetch_teams_for_account(result["account_id"])
-            result["experiments"] = expt_repo.fetch_experiments_by_team(list(result["teams"]))
-            result["teams"] = {str(k): v.model_dump() for k, v in result["teams"].items()}
-            result["experiments"] = {str(k): v.model_dump() for k, v in result["experiments"].items()}
-            return result
+            stmt = select(*account_columns)
+        stmt = stmt.where(accounts_table.c.account_id.in_(account_ids))
+
+        results = {}
+        teams = {}
+        for row in conn.execute(stmt):
+            result = results.get(row.account_id)
+            if result is None:
+                result = results[row.account_id] = {
+                    "account_id": row.account_id,
+                    "email": row.email,
+                    "status": row.status,
+                    "source": row.source,
+                    "subsource": row.subsource,
+                    "teams": {},
+                    "experiments": {},
+                }
+            if not include_teams or row.team_id is None:
+                continue
+            team = teams.setdefault(row.team_id, Team(team_id=row.team_id, team_name=row.team_name, members=[]))
+            if row.member_id not in team.members:
+                team.members.append(row.member_id)
+            result["teams"][row.team_id] = team
+
+        experiments = {}
+        if include_experiments and teams:
+            expt_repo = DbExperimentRepository(conn)
+            experiments = expt_repo.fetch_experiments_by_team(list(teams))
+
+    accounts = []
+    for result in results.values():
+        result["experiments"] = {
+            # an experiment without an owning team belongs to no account's teams
+            str(k): v.model_dump()
+            for k, v in experiments.items()
+            if v.owner is not None and v.owner.team_id in result["teams"]
+        }
+        result["teams"] = {str(k): v.model_dump() for k, v in result["teams"].items()}
+        accounts.append(result)
+    return accounts
 
 
 def get_account_by_email(email):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account = account_repo.fetch_account_by_email(email)
         if account:
@@ -88,48 +508,47 @@ def get_account_by_email(email):
 
 
 def finish_consent(account_id, consent_version):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account_repo.store_consent(account_id, consent_version)
         account_repo.update_status(account_id, "pending_initial_preferences")
-        conn.commit()
+    notify_account_changed(account_id)
 
 
 def finish_topic_selection(account_id):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account_repo.update_status(account_id, "pending_demographic_survey")
-        conn.commit()
+    notify_account_changed(account_id)
 
 
 def finish_demographic_survey(account_id):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account_repo.update_status(account_id, "pending_compensation_preference")
-        conn.commit()
+    notify_account_changed(account_id)
 
 
 def finish_onboarding(account_id):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         account_repo.update_status(account_id, "onboarding_done")
 
         subscription_repo = DbSubscriptionRepository(conn)
         subscription_repo.store_subscription_for_account(account_id)
-        conn.commit()
+    notify_account_changed(account_id)
 
 
 def create_token() -> Token:
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         token_repo = DbTokenRepository(conn)
         token = token_repo.create_token()
-        conn.commit()
         return token
 
 
 def get_token(token_id) -> Token | None:
     now = datetime.now(timezone.utc).astimezone()
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         token_repo = DbTokenRepository(conn)
         token = token_repo.fetch_token_by_id(token_id)
         if token is None:
@@ -163,7 +582,7 @@ def fetch_demographic_information(account_id):
             "email_client_other": custom_email_clients,
         }
 
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         repo = DbDemographicsRepository(conn)
         account_repo = DbAccountRepository(conn)
         demographics = repo.fetch_latest_demographics_by_account_id(account_id)
@@ -177,15 +596,48 @@ def fetch_demographic_information(account_id):
 
 
 def fetch_compensation_preferences(account_id):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         compensation = account_repo.fetch_compensation(account_id)
 
     return compensation
 
 
+def exclude_scanner_clicks(conn, clicks_by_account) -> dict:
+    """Leave out the clicks only a suspected email scanner made, by the SCANNER_HEADER tag on the stored click.
+
+    poprox-storage returns clicks without their headers, so an article clicked
+    from a newsletter by both a scanner and a person is kept.
+    """
+    newsletter_ids = {click.newsletter_id for clicks in clicks_by_account.values() for click in clicks}
+    if not newsletter_ids:
+        return clicks_by_account
+    clicks_table = storage_table(conn, "clicks")
+    tagged = cast(clicks_table.c.headers, JSONB)[SCANNER_HEADER].astext.is_not(None)
+    scanner_only = {
+        tuple(row)
+        for row in conn.execute(
+            select(clicks_table.c.account_id, clicks_table.c.newsletter_id, clicks_table.c.article_id)
+            .where(
+                clicks_table.c.account_id.in_(list(clicks_by_account)),
+                clicks_table.c.newsletter_id.in_(newsletter_ids),
+            )
+            .group_by(clicks_table.c.account_id, clicks_table.c.newsletter_id, clicks_table.c.article_id)
+            .having(func.bool_and(tagged))
+        )
+    }
+    if not scanner_only:
+        return clicks_by_account
+    return {
+        account_id: [
+            click for click in clicks if (account_id, click.newsletter_id, click.article_id) not in scanner_only
+        ]
+        for account_id, clicks in clicks_by_account.items()
+    }
+
+
 def fetch_user_click_and_survey_activity(account_id, start_date, end_date):
-    with DB_ENGINE.connect() as conn:
+    with db_connection() as conn:
         account_repo = DbAccountRepository(conn)
         click_repo = DbClicksRepository(conn)
         survey_repo = DbQualtricsSurveyRepository(conn)
@@ -194,9 +646,9 @@ def fetch_user_click_and_survey_activity(account_id, start_date, end_date):
         click_count = 0
         survey_count = 0
 
+        clicked_newsletters = set()
         if account_id in user_click_activity:
-            filtered_clicks = filter_click_histories(user_click_activity)
-            clicked_newsletters = set()
+            filtered_clicks = filter_click_histories(exclude_scanner_clicks(conn, user_click_activity))
             for click in filtered_clicks[account_id]:
                 clicked_newsletters.add(click.newsletter_id)
             click_count = len(clicked_newsletters)
@@ -206,4 +658,5 @@ def fetch_user_click_and_survey_activity(account_id, start_date, end_date):
         return {
             "click_count": click_count,
             "survey_count": survey_count,
+            "clicked_newsletters": clicked_newsletters,
         }
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from os import environ as env
+
+CLICK_SCANNER_MODE = env.get("CLICK_SCANNER_MODE", "tag")  # "tag", "drop" or "off"
+CLICK_SCANNER_WINDOW = float(env.get("CLICK_SCANNER_WINDOW", 10.0))
+CLICK_SCANNER_BURST = int(env.get("CLICK_SCANNER_BURST", 4))
+
+# added to the stored headers of clicks we think a scanner made, with the reason as its value. Tagged clicks are
+# left out of the activity counts and the admin click stats (`exclude_scanner_clicks`); anything else reading the
+# clicks table -- recommenders, compensation, analysis -- should skip rows whose headers have this key, e.g.
+# `WHERE headers ->> 'X-Poprox-Suspected-Scanner' IS NULL`.
+SCANNER_HEADER = "X-Poprox-Suspected-Scanner"
+
+SCANNER_AGENT_MARKERS = (
+    "bot",
+    "crawler",
+    "spider",
+    "scanner",
+    "preview",
+    "barracuda",
+    "mimecast",
+    "proofpoint",
+    "symantec",
+    "trendmicro",
+    "safelinks",
+    "python-requests",
+    "curl/",
+    "wget/",
+    "go-http-client",
+    "headlesschrome",
+)
+PREFETCH_HEADERS = ("Purpose", "Sec-Purpose", "X-Purpose", "X-Moz")
+
+
+class ScannerDetector:
+    """Sliding-window detector for clicks made by email security scanners and link prefetchers.
+
+    A click is suspect if its headers say so (a prefetch purpose, a known
+    scanner user agent, no user agent at all) or if the same client opens
+    `burst` or more different links from one newsletter within `window`
+    seconds -- faster than anybody reads.
+    """
+
+    def __init__(self, window=CLICK_SCANNER_WINDOW, burst=CLICK_SCANNER_BURST, max_keys=100_000) -> None:
+        self._window = window
+        self._burst = burst
+        self._max_keys = max_keys
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def check(self, account_id, newsletter_id, impression_id, headers, now=None) -> str | None:
+        """Record this click and return why it looks automated, or None if it looks human."""
+        reason = self._header_reason(headers)
+        burst = self._observe(account_id, newsletter_id, impression_id, headers, now)
+        reason = reason or burst
+        if reason:
+            with self._lock:
+                self._counts[reason] = self._counts.get(reason, 0) + 1
+        return reason
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tracked_keys": len(self._recent), "suspected": dict(self._counts)}
+
+    @staticmethod
+    def _header_reason(headers):
+        for name in PREFETCH_HEADERS:
+            if "prefetch" in headers.get(name, "").lower():
+                return "prefetch"
+        agent = headers.get("User-Agent", "").lower()
+        if not agent:
+            return "no-user-agent"
+        if any(marker in agent for marker in SCANNER_AGENT_MARKERS):
+            return "scanner-agent"
+        return None
+
+    def _observe(self, account_id, newsletter_id, impression_id, headers, now):
+        now = time.monotonic() if now is None else now
+        key = (account_id, newsletter_id, headers.get("User-Agent", ""))
+        with self._lock:
+            clicks = self._recent.pop(key, None) or deque()
+            while clicks and now - clicks[0][0] > self._window:
+                clicks.popleft()
+            clicks.append((now, impression_id))
+            self._recent[key] = clicks
+            # keys are kept in least-recently-seen order, so stale ones collect at the front
+            while self._recent and now - next(iter(self._recent.values()))[-1][0] > self._window:
+                self._recent.popitem(last=False)
+            while len(self._recent) > self._max_keys:
+                self._recent.popitem(last=False)
+
+            if len({impression for _, impression in clicks}) >= self._burst:
+                return "burst"
+        return None
+
+
+scanner_detector = ScannerDetector()
@@ -0,0 +1,190 @@
+import logging
+import secrets
+import threading
+from datetime import datetime, timezone
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.datastructures import CallbackDict
+
+from util.tables import web_table
+
+logger = logging.getLogger(__name__)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, session_id=None, new=False) -> None:
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.session_id = session_id
+        self.new = new
+        self.modified = False
+        self.replaced_id = None
+
+    def rotate(self) -> None:
+        if not self.new and self.replaced_id is None:
+            self.replaced_id = self.session_id
+        self.session_id = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+def rotate_session_id(session) -> None:
+    """Move the session to a new id, e.g. on login, so an id someone planted beforehand (session fixation) is useless.
+
+    The old id is deleted from the store when the response is saved. A no-op
+    with Flask's cookie sessions, which have no id to steal.
+    """
+    if isinstance(session, ServerSideSession):
+        session.rotate()
+
+
+class MemorySessionStore:
+    """In-process stand-in for development and tests. Sessions don't survive a restart or cross workers."""
+
+    def __init__(self) -> None:
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, session_id) -> str | None:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry[0] < datetime.now(timezone.utc):
+                self._sessions.pop(session_id, None)
+                return None
+            return entry[1]
+
+    def save(self, session_id, data, expires_at) -> None:
+        with self._lock:
+            self._sessions[session_id] = (expires_at, data)
+
+    def delete(self, session_id) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class PostgresSessionStore:
+    """Sessions kept in the web_sessions table, shared by every worker."""
+
+    PURGE_EVERY = 500  # saves between sweeps of expired sessions
+
+    def __init__(self, engine) -> None:
+        self._engine = engine
+        self._saves = 0
+
+    def load(self, session_id) -> str | None:
+        with self._engine.connect() as conn:
+            sessions_table = web_table("web_sessions")
+            row = conn.execute(
+                select(sessions_table.c.data).where(
+                    sessions_table.c.session_id == session_id,
+                    sessions_table.c.expires_at > datetime.now(timezone.utc),
+                )
+            ).first()
+        return row.data if row else None
+
+    def save(self, session_id, data, expires_at) -> None:
+        with self._engine.connect() as conn:
+            sessions_table = web_table("web_sessions")
+            stmt = insert(sessions_table).values(session_id=session_id, data=data, expires_at=expires_at)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[sessions_table.c.session_id],
+                set_={"data": stmt.excluded.data, "expires_at": stmt.excluded.expires_at},
+            )
+            conn.execute(stmt)
+            self._saves += 1
+            if self._saves % self.PURGE_EVERY == 0:
+                conn.execute(delete(sessions_table).where(sessions_table.c.expires_at <= datetime.now(timezone.utc)))
+            conn.commit()
+
+    def delete(self, session_id) -> None:
+        with self._engine.connect() as conn:
+            sessions_table = web_table("web_sessions")
+            conn.execute(delete(sessions_table).where(sessions_table.c.session_id == session_id))
+            conn.commit()
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session contents in a store on the server; the cookie only carries a signed, opaque session id."""
+
+    serializer = TaggedJSONSerializer()
+    salt = "poprox-server-session"
+
+    def __init__(self, store) -> None:
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if app.has_static_folder and request.path.startswith(app.static_url_path + "/"):
+            # static files never look at the session, so don't pay a store lookup for each one. By path,
+            # since the session is opened before the URL is matched to an endpoint.
+            cookie = None
+        if cookie:
+            try:
+                session_id = self._signer(app).unsign(cookie).decode("utf-8")
+            except BadSignature:
+                session_id = None
+            if session_id:
+                try:
+                    data = self.store.load(session_id)
+                except Exception:
+                    logger.exception("couldn't load session, starting a new one")
+                    data = None
+                if data is not None:
+                    return ServerSideSession(self.serializer.loads(data), session_id=session_id)
+        return ServerSideSession(session_id=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced_id is not None:
+            try:
+                self.store.delete(session.replaced_id)
+            except Exception:
+                # it expires on its own; the browser no longer has it either way
+                logger.exception("couldn't delete a rotated-out session")
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.session_id)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not self.should_set_cookie(app, session) and not session.new:
+            return
+
+        if session.modified or session.new:
+            expires_at = datetime.now(timezone.utc) + app.permanent_session_lifetime
+            self.store.save(session.session_id, self.serializer.dumps(dict(session)), expires_at)
+
+        response.vary.add("Cookie")
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.session_id).decode("utf-8"),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def make_session_interface(backend, engine) -> SessionInterface | None:
+    """Session interface for SESSION_BACKEND: "postgres", "memory", or "cookie" for Flask's default signed cookie."""
+    if backend == "postgres":
+        return ServerSideSessionInterface(PostgresSessionStore(engine))
+    if backend == "memory":
+        return ServerSideSessionInterface(MemorySessionStore())
+    if backend != "cookie":
+        raise RuntimeError(f"unknown SESSION_BACKEND {backend!r}")
+    return None
@@ -0,0 +1,86 @@
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class Spool:
+    """Append-only JSON-lines file on local disk, shared by every worker process.
+
+    Each append is fsync'd before returning. Readers `claim` the current file by
+    renaming it out of the way, so appends made while a claim is being processed
+    land in a fresh file instead of being lost.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self._lock_path = self.path.with_name(self.path.name + ".lock")
+
+    @contextmanager
+    def _locked(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, records) -> None:
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        if not lines:
+            return
+        with self._locked():
+            with open(self.path, "a", encoding="utf-8") as spool_file:
+                spool_file.write(lines)
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+
+    def has_pending(self) -> bool:
+        if self.path.exists() and self.path.stat().st_size > 0:
+            return True
+        return any(True for _ in self._claimed_files())
+
+    def claim(self) -> list[Path]:
+        """Move the live spool aside and return every claimed file that still needs processing."""
+        with self._locked():
+            if self.path.exists() and self.path.stat().st_size > 0:
+                self.path.rename(self.path.with_name(f"{self.path.name}.claimed-{os.getpid()}-{os.urandom(4).hex()}"))
+            return sorted(self._claimed_files())
+
+    def _claimed_files(self):
+        for claimed in self.path.parent.glob(self.path.name + ".claimed-*"):
+            owner = int(claimed.name.rsplit("-", 2)[1])
+            # leave files alone while another live process is working through them
+            if owner == os.getpid() or not _pid_alive(owner):
+                yield claimed
+
+    @staticmethod
+    def read(claimed: Path) -> list[dict]:
+        records = []
+        with open(claimed, encoding="utf-8") as spool_file:
+            for line in spool_file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # a torn final line from a crash mid-write
+                    logger.warning("skipping unreadable line in %s", claimed)
+        return records
+
+    @staticmethod
+    def release(claimed: Path) -> None:
+        claimed.unlink(missing_ok=True)
+
+
+def _pid_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
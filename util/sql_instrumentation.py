@@ -0,0 +1,90 @@
+import json
+import logging
+import re
+import time
+from os import environ as env
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SQL_INSTRUMENTATION = env.get("SQL_INSTRUMENTATION", "true").lower() in ("1", "true", "yes")
+SQL_SERVER_TIMING = env.get("SQL_SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+SQL_SLOWEST_STATEMENTS = int(env.get("SQL_SLOWEST_STATEMENTS", 3))
+# a statement run this many times in one request is probably a query in a loop
+SQL_N_PLUS_ONE_THRESHOLD = int(env.get("SQL_N_PLUS_ONE_THRESHOLD", 5))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class RequestQueries:
+    """Queries run while handling one request."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_seconds = 0.0
+        self.slowest = []  # (seconds, statement), slowest first
+        self.shapes = {}  # statement -> times run
+
+    def record(self, statement, seconds) -> None:
+        # parameters are bound separately, so the text is already the statement's shape
+        statement = _WHITESPACE.sub(" ", statement).strip()
+        self.count += 1
+        self.total_seconds += seconds
+        self.shapes[statement] = self.shapes.get(statement, 0) + 1
+        if len(self.slowest) < SQL_SLOWEST_STATEMENTS or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda entry: entry[0], reverse=True)
+            del self.slowest[SQL_SLOWEST_STATEMENTS:]
+
+    def repeated(self) -> dict:
+        return {statement: n for statement, n in self.shapes.items() if n >= SQL_N_PLUS_ONE_THRESHOLD}
+
+    def summary(self) -> dict:
+        return {
+            "queries": self.count,
+            "db_ms": round(self.total_seconds * 1000, 2),
+            "slowest": [{"ms": round(seconds * 1000, 2), "sql": statement} for seconds, statement in self.slowest],
+            "likely_n_plus_one": [{"times": n, "sql": statement} for statement, n in self.repeated().items()],
+        }
+
+
+def instrument_engine(engine) -> None:
+    """Count and time the statements this engine runs on behalf of a request."""
+    if not SQL_INSTRUMENTATION:
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started_at"].pop()
+    if not has_request_context():
+        return  # background flushes and CLI commands
+    queries = g.get("sql_queries")
+    if queries is None:
+        queries = g.sql_queries = RequestQueries()
+    queries.record(statement, time.perf_counter() - started)
+
+
+def report_request_queries(response):
+    """after_request hook: log what the request asked of the database, and optionally tell the browser."""
+    queries = g.get("sql_queries")
+    if queries is None:
+        return response
+
+    summary = queries.summary()
+    line = json.dumps({"event": "request_sql", "method": request.method, "endpoint": request.endpoint, **summary})
+    if summary["likely_n_plus_one"]:
+        logger.warning(line)
+    else:
+        logger.info(line)
+
+    if SQL_SERVER_TIMING:
+        response.headers.add("Server-Timing", f'db;dur={summary["db_ms"]};desc="{queries.count} queries"')
+    return response
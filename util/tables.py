@@ -0,0 +1,108 @@
+import threading
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Text, Uuid, func
+
+# tables owned by poprox-storage, reflected on first use for the bulk paths that the repositories don't cover
+_STORAGE_METADATA = MetaData()
+_reflect_lock = threading.Lock()
+
+# tables owned by poprox-web itself, created by `flask create-web-tables` (see create_web_tables)
+WEB_METADATA = MetaData()
+
+newsletter_opens = Table(
+    "web_newsletter_opens",
+    WEB_METADATA,
+    Column("account_id", Uuid, primary_key=True),
+    Column("newsletter_id", Uuid, primary_key=True),
+    Column("first_opened_at", DateTime(timezone=True), nullable=False),
+    Column("last_opened_at", DateTime(timezone=True), nullable=False),
+    Column("open_count", Integer, nullable=False),
+)
+
+sessions = Table(
+    "web_sessions",
+    WEB_METADATA,
+    Column("session_id", String, primary_key=True),
+    Column("data", Text, nullable=False),
+    Column("expires_at", DateTime(timezone=True), nullable=False, index=True),
+)
+
+# how many mentions of each entity are in the articles an account has clicked, kept up to date as clicks are stored
+entity_affinity = Table(
+    "web_entity_affinity",
+    WEB_METADATA,
+    Column("account_id", Uuid, primary_key=True),
+    Column("entity_id", Uuid, primary_key=True),
+    Column("entity_name", String, nullable=False),
+    Column("entity_type", String, nullable=False),
+    Column("mentions", Integer, nullable=False),
+)
+
+# the clicked articles already counted in web_entity_affinity, so clicking an article again doesn't count twice
+entity_affinity_articles = Table(
+    "web_entity_affinity_articles",
+    WEB_METADATA,
+    Column("account_id", Uuid, primary_key=True),
+    Column("article_id", Uuid, primary_key=True),
+)
+
+# accounts whose clicks from before web_entity_affinity existed have been counted
+entity_affinity_accounts = Table(
+    "web_entity_affinity_accounts",
+    WEB_METADATA,
+    Column("account_id", Uuid, primary_key=True),
+    Column("seeded_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+# bumped whenever something an account's entity suggestions depend on changes, for their ETags
+account_versions = Table(
+    "web_account_versions",
+    WEB_METADATA,
+    Column("account_id", Uuid, primary_key=True),
+    Column("version", Integer, nullable=False),
+)
+
+# clicked-newsletter and survey counts for an account's compensation period, as shown on the compensation page
+activity_counters = Table(
+    "web_activity_counters",
+    WEB_METADATA,
+    Column("account_id", Uuid, primary_key=True),
+    Column("period_start", DateTime(timezone=True), primary_key=True),
+    Column("period_end", DateTime(timezone=True), primary_key=True),
+    Column("click_count", Integer, nullable=False),
+    Column("survey_count", Integer, nullable=False),
+    # bumped whenever clicks are added to click_count, so a recount that raced them can tell
+    Column("changes", Integer, nullable=False),
+    Column("reconciled_at", DateTime(timezone=True), nullable=False),
+)
+
+# the newsletters already in an account's click_count for a period, so clicking one again doesn't count twice
+activity_counted_newsletters = Table(
+    "web_activity_counted_newsletters",
+    WEB_METADATA,
+    Column("account_id", Uuid, primary_key=True),
+    Column("period_start", DateTime(timezone=True), primary_key=True),
+    Column("period_end", DateTime(timezone=True), primary_key=True),
+    Column("newsletter_id", Uuid, primary_key=True),
+)
+
+
+def storage_table(conn, name) -> Table:
+    with _reflect_lock:
+        if name in _STORAGE_METADATA.tables:
+            return _STORAGE_METADATA.tables[name]
+        return Table(name, _STORAGE_METADATA, autoload_with=conn)
+
+
+def web_table(name) -> Table:
+    return WEB_METADATA.tables[name]
+
+
+def create_web_tables(engine) -> None:
+    """Create any of poprox-web's own tables that don't exist yet. Run once per deploy, not from workers."""
+    WEB_METADATA.create_all(engine, checkfirst=True)
+
+
+def rows_for(table: Table, records) -> list[dict]:
+    """Trim each record down to the columns the table actually has."""
+    return [{k: v for k, v in record.items() if k in table.c} for record in records]
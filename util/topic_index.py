@@ -0,0 +1,52 @@
+import logging
+import threading
+from os import environ as env
+from uuid import UUID
+
+from poprox_storage.repositories.account_interest_log import DbAccountInterestRepository
+
+from poprox_concepts.domain.topics import GENERAL_TOPICS
+from util.postgres_db import db_connection
+from util.write_buffer import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+TOPIC_INDEX_REFRESH_INTERVAL = float(env.get("TOPIC_INDEX_REFRESH_INTERVAL", 15 * 60))
+
+
+class TopicIndex:
+    """Topic name -> entity_id for a fixed set of topics, loaded once per worker and refreshed on a timer."""
+
+    def __init__(self, names, refresh_interval=TOPIC_INDEX_REFRESH_INTERVAL) -> None:
+        self._names = list(names)
+        self._ids = None
+        self._load_lock = threading.Lock()
+        self._task = PeriodicTask("topic-index", self.refresh, refresh_interval)
+
+    def entity_id(self, name) -> UUID | None:
+        return self.entity_ids().get(name)
+
+    def entity_ids(self) -> dict[str, UUID]:
+        if self._ids is None:
+            self.warm()
+        return self._ids
+
+    def warm(self) -> None:
+        """Load the index now, e.g. when a worker starts, instead of on the first preference save."""
+        with self._load_lock:
+            if self._ids is None:
+                self.refresh()
+        self._task.ensure_started()
+
+    def refresh(self) -> None:
+        with db_connection() as conn:
+            repo = DbAccountInterestRepository(conn)
+            ids = {name: repo.fetch_entity_by_name(name) for name in self._names}
+        missing = [name for name, entity_id in ids.items() if entity_id is None]
+        if missing:
+            logger.warning(f"no entity for topics {missing}")
+        # swapped in whole, so readers never see a half-built index
+        self._ids = {name: entity_id for name, entity_id in ids.items() if entity_id is not None}
+
+
+topic_index = TopicIndex(GENERAL_TOPICS)
@@ -0,0 +1,177 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# every buffer created in this process, so shutdown hooks and the admin stats endpoint can find them
+BUFFERS = []
+
+
+class WriteBuffer:
+    """In-process buffer that hands pending items to `flush_fn` in batches.
+
+    A background thread flushes whenever `max_items` items are pending or
+    `flush_interval` seconds have passed, whichever comes first. `add` never
+    waits on the database, so request handlers can return immediately. If
+    `flush_fn` raises, the failed batch is passed to `on_error` (when given).
+    """
+
+    def __init__(self, name, flush_fn, max_items=200, flush_interval=2.0, max_pending=50_000, on_error=None) -> None:
+        self.name = name
+        self._flush_fn = flush_fn
+        self._on_error = on_error
+        self._max_items = max_items
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+        self._added = 0
+        self._dropped = 0
+        self._flushed = 0
+        self._failed = 0
+        self._flushes = 0
+        self._last_flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+        self._total_flush_seconds = 0.0
+
+        BUFFERS.append(self)
+
+    def add(self, item) -> bool:
+        """Queue an item for the next flush. Returns False if the buffer is full and the item was dropped."""
+        self._ensure_started()
+        with self._lock:
+            if len(self._pending) >= self._max_pending:
+                self._dropped += 1
+                return False
+            self._pending.append(item)
+            self._added += 1
+            full = len(self._pending) >= self._max_items
+        if full:
+            self._wakeup.set()
+        return True
+
+    def flush(self) -> int:
+        """Write out everything pending right now, on the calling thread."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                self._flush_fn(batch)
+                self._flushed += len(batch)
+            except Exception:
+                self._failed += len(batch)
+                logger.exception("%s: failed to flush %d items", self.name, len(batch))
+                if self._on_error is not None:
+                    try:
+                        self._on_error(batch)
+                    except Exception:
+                        logger.exception("%s: error handler failed, %d items lost", self.name, len(batch))
+            finally:
+                elapsed = time.perf_counter() - start
+                self._flushes += 1
+                self._last_flush_seconds = elapsed
+                self._max_flush_seconds = max(self._max_flush_seconds, elapsed)
+                self._total_flush_seconds += elapsed
+            return len(batch)
+
+    def close(self) -> None:
+        """Stop the background thread and flush whatever is left."""
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            depth = len(self._pending)
+        return {
+            "queue_depth": depth,
+            "added": self._added,
+            "dropped": self._dropped,
+            "flushed": self._flushed,
+            "failed": self._failed,
+            "flushes": self._flushes,
+            "last_flush_seconds": self._last_flush_seconds,
+            "max_flush_seconds": self._max_flush_seconds,
+            "mean_flush_seconds": self._total_flush_seconds / self._flushes if self._flushes else 0.0,
+        }
+
+    def _ensure_started(self):
+        # threads don't survive a fork, so start one lazily in whichever (gunicorn worker) process uses the buffer
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-flusher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class PeriodicTask:
+    """Runs `fn` every `interval` seconds on a daemon thread, started lazily in the process that needs it."""
+
+    def __init__(self, name, fn, interval) -> None:
+        self.name = name
+        self._fn = fn
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pid = None
+
+    def ensure_started(self) -> None:
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._stop.clear()
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self._fn()
+            except Exception:
+                logger.exception("%s: periodic task failed", self.name)
+
+
+def buffer_stats() -> dict:
+    return {buffer.name: buffer.stats() for buffer in BUFFERS}
+
+
+def close_all_buffers() -> None:
+    for buffer in BUFFERS:
+        try:
+            buffer.close()
+        except Exception:
+            logger.exception("%s: failed to flush on shutdown", buffer.name)
+
+
+atexit.register(close_all_buffers)